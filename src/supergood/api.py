@@ -18,6 +18,10 @@ class Api(object):
         self.event_sink_url = None
         self.error_sink_url = None
         self.config_pull_url = None
+        # ETag of the last config pulled, sent back so unchanged configs return a 304
+        self.config_etag = None
+        # True when the last config pull returned a 304
+        self.config_not_modified = False
         self.telemetry_post_url = None
         self.log = None
 
@@ -52,17 +56,28 @@ class Api(object):
         self.config_pull_url = urljoin(self.base_url, endpoint)
 
     def get_config(self):
+        """
+        Returns the remote config, or None if it could not be fetched
+        or has not changed since the last pull
+        """
         if not self.config_pull_url:
             raise Exception(ERRORS["UNINITIALIZED"])
-        response = requests.get(self.config_pull_url, headers=self.header_options)
+        headers = self.header_options
+        if self.config_etag:
+            headers = dict(self.header_options, **{"If-None-Match": self.config_etag})
+        response = requests.get(self.config_pull_url, headers=headers)
+        self.config_not_modified = response.status_code == 304
         if response.status_code == 401:
             raise Exception(ERRORS["UNAUTHORIZED"])
+        elif response.status_code == 304:
+            return None
         elif response.status_code != 200:
             if self.log:
                 self.log.warning(
                     f"[Supergood] Got non-2xx status code {response.status_code} on config get"
                 )
             return None
+        self.config_etag = response.headers.get("ETag")
         return response.json()
 
     # Event posting
@@ -0,0 +1,474 @@
+import itertools
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+
+@dataclass
+class CapturedRequest:
+    """
+    A request as recorded on the calling thread in deferred decoding mode
+    Fields hold exactly what the vendor patch passed in: nothing is decoded,
+    parsed or matched against the remote config until the cache is flushed
+    requested_at: time.perf_counter_ns() when the request was captured
+    truncation: how a streamed body was cut off while it was sent, if it was
+    """
+
+    request_id: Any
+    url: Any
+    method: Any
+    body: Any
+    headers: Any
+    requested_at: int
+    tags: Optional[Dict]
+    truncation: Optional[Dict]
+
+
+@dataclass
+class CapturedResponse:
+    """
+    A response as recorded on the calling thread in deferred decoding mode
+    request: the CapturedRequest this response answers
+    responded_at: time.perf_counter_ns() when the response was captured
+    first_byte_at: time.perf_counter_ns() when the response headers arrived, if known
+    truncation: how a streamed body was cut off while it was read, if it was
+    connection_reused: whether the request went out on a pooled connection, if known
+    """
+
+    request: CapturedRequest
+    body: Any
+    headers: Any
+    status: Any
+    status_text: Any
+    responded_at: int
+    first_byte_at: Optional[int]
+    truncation: Optional[Dict]
+    connection_reused: Optional[bool]
+
+
+def estimate_size(*parts):
+    """
+    Rough size in bytes of a cached request or event, which is dominated by
+    its url and raw bodies. Parts that aren't text or bytes (e.g. a streamed
+    upload) are not counted
+    """
+    size = 0
+    for part in parts:
+        if isinstance(part, (str, bytes, bytearray)):
+            size += len(part)
+    return size
+
+
+class RequestStore(object):
+    """
+    Requests waiting on their response, keyed on request id
+    A request that never gets one (its response body is never read, or the call
+    failed) would otherwise stay cached for the life of the process, so:
+    ttl: entries stored longer than this (ns) are removed by `expire`, even if
+      their response is still being streamed, so it should outlast the longest streams
+    max_bytes: once entries add up to more than this, the oldest are evicted
+    Either limit is off when None
+    """
+
+    def __init__(self, ttl=None, max_bytes=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        # request id => (entry, stored_at, size), oldest first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, request_id, entry, size=0):
+        stored_at = time.perf_counter_ns()
+        with self._lock:
+            previous = self._entries.pop(request_id, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._entries[request_id] = (entry, stored_at, size)
+            self.bytes += size
+            if self.max_bytes is None:
+                return
+            # the newest entry is always kept, even if it is over the limit by itself
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, request_id, default=None):
+        entry, _ = self.take(request_id)
+        return default if entry is None else entry
+
+    def take(self, request_id):
+        """
+        Removes an entry, returns (entry, size), or (None, 0) if it isn't stored
+        """
+        with self._lock:
+            stored = self._entries.pop(request_id, None)
+            if stored is None:
+                return None, 0
+            self.bytes -= stored[2]
+            return stored[0], stored[2]
+
+    def expire(self, now=None):
+        """
+        Removes and returns the entries stored more than ttl ago, oldest first
+        """
+        if self.ttl is None:
+            return []
+        if now is None:
+            now = time.perf_counter_ns()
+        expired = []
+        with self._lock:
+            while self._entries:
+                request_id = next(iter(self._entries))
+                entry, stored_at, size = self._entries[request_id]
+                if now - stored_at < self.ttl:
+                    break
+                del self._entries[request_id]
+                self.bytes -= size
+                expired.append(entry)
+            self.expirations += len(expired)
+        return expired
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def values(self):
+        with self._lock:
+            return [entry for (entry, _, _) in self._entries.values()]
+
+    def drain(self):
+        """
+        Removes and returns every entry, oldest first
+        """
+        with self._lock:
+            entries = self._entries
+            self._entries = OrderedDict()
+            self.bytes = 0
+        return [entry for (entry, _, _) in entries.values()]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "bytes": self.bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class EventBuffer(object):
+    """
+    Completed events waiting to be flushed, keyed on request id
+    max_events, max_bytes: bound the buffer, either is off when None
+    policy: what is dropped when a new event doesn't fit
+      drop-newest: the new event
+      drop-oldest: the oldest buffered events, until the new one fits
+      sample-down: the new event or random buffered ones, so the buffer holds a
+        uniform sample of everything offered since it was last empty
+    """
+
+    POLICIES = ("drop-newest", "drop-oldest", "sample-down")
+
+    def __init__(self, max_events=None, max_bytes=None, policy="drop-oldest"):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.bytes = 0
+        self.dropped = 0
+        # events offered since the buffer was last empty, for sample-down
+        self._offered = 0
+        # key => (event, size), oldest first
+        self._entries = OrderedDict()
+        # the same keys in no particular order, to pick one at random
+        self._keys = []
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fits(self, size):
+        return (self.max_events is None or len(self._entries) < self.max_events) and (
+            self.max_bytes is None or self.bytes + size <= self.max_bytes
+        )
+
+    def _remove(self, key):
+        stored = self._entries.pop(key, None)
+        if stored is None:
+            return None
+        self.bytes -= stored[1]
+        # swap the last key into this one's place, so removal is O(1)
+        position = self._positions.pop(key)
+        last = self._keys.pop()
+        if last != key:
+            self._keys[position] = last
+            self._positions[last] = position
+        return stored[0]
+
+    def put(self, key, event, size=0):
+        """
+        Buffers an event, returns False if it was dropped instead
+        """
+        with self._lock:
+            self._remove(key)
+            if not self._entries:
+                self._offered = 0
+            self._offered += 1
+            if not self._fits(size):
+                if (
+                    self.policy == "drop-newest"
+                    or self.max_events == 0
+                    or (self.max_bytes is not None and size > self.max_bytes)
+                    or (
+                        self.policy == "sample-down"
+                        and random.randrange(self._offered) >= len(self._entries)
+                    )
+                ):
+                    self.dropped += 1
+                    return False
+                while not self._fits(size):
+                    if self.policy == "sample-down":
+                        self._remove(random.choice(self._keys))
+                    else:
+                        self._remove(next(iter(self._entries)))
+                    self.dropped += 1
+            self._entries[key] = (event, size)
+            self._positions[key] = len(self._keys)
+            self._keys.append(key)
+            self.bytes += size
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            event = self._remove(key)
+        return default if event is None else event
+
+    def evict(self, at_random=False):
+        """
+        Drops the oldest buffered event, or a random one. False if there were none
+        """
+        with self._lock:
+            if not self._entries:
+                return False
+            if at_random:
+                self._remove(random.choice(self._keys))
+            else:
+                self._remove(next(iter(self._entries)))
+            self.dropped += 1
+            return True
+
+    def count_drop(self):
+        """
+        Records an event that was dropped before it got here
+        """
+        with self._lock:
+            self.dropped += 1
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def values(self):
+        with self._lock:
+            return [event for (event, _) in self._entries.values()]
+
+    def swap(self):
+        """
+        Takes every buffered event, oldest first, leaving the buffer empty
+        The full containers are exchanged for empty ones, so writers only ever
+        wait on the lock for that exchange, however many events were buffered
+        """
+        with self._lock:
+            entries = self._entries
+            self._entries = OrderedDict()
+            self._keys = []
+            self._positions = {}
+            self.bytes = 0
+            self._offered = 0
+        return [event for (event, _) in entries.values()]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self._positions.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "bytes": self.bytes,
+            "dropped": self.dropped,
+        }
+
+
+def _split_limit(limit, shards):
+    """
+    Each shard's share of a limit, rounded up
+    """
+    return None if limit is None else -(-limit // shards)
+
+
+def _sum_stats(shards):
+    totals = {}
+    for shard in shards:
+        for key, value in shard.stats().items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+class ShardedRequestStore(object):
+    """
+    A RequestStore split into shards by request id, so concurrent request
+    threads rarely wait on the same lock. A response finds its request in the
+    same shard whichever thread or task completes it
+    ttl, max_bytes: as for RequestStore, max_bytes is split evenly across shards
+    """
+
+    def __init__(self, shards, ttl=None, max_bytes=None):
+        self.shards = [
+            RequestStore(ttl=ttl, max_bytes=_split_limit(max_bytes, shards))
+            for _ in range(shards)
+        ]
+
+    def _shard(self, request_id):
+        return self.shards[hash(request_id) % len(self.shards)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def put(self, request_id, entry, size=0):
+        self._shard(request_id).put(request_id, entry, size)
+
+    def pop(self, request_id, default=None):
+        return self._shard(request_id).pop(request_id, default)
+
+    def take(self, request_id):
+        return self._shard(request_id).take(request_id)
+
+    def expire(self, now=None):
+        expired = []
+        for shard in self.shards:
+            expired += shard.expire(now)
+        return expired
+
+    def drain(self):
+        entries = []
+        for shard in self.shards:
+            entries += shard.drain()
+        return entries
+
+    def keys(self):
+        return [key for shard in self.shards for key in shard.keys()]
+
+    def values(self):
+        return [entry for shard in self.shards for entry in shard.values()]
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    def stats(self):
+        return _sum_stats(self.shards)
+
+
+class ShardedEventBuffer(object):
+    """
+    An EventBuffer split into shards, each thread writing to its own one, so
+    request threads don't contend on a single lock. The flusher swaps every
+    shard out in turn
+    max_events, max_bytes: limits on the whole buffer, however many shards are used
+    policy: as for EventBuffer. Events are evicted from the writing thread's
+      shard, or the fullest one if it's empty, so drop-oldest drops that shard's oldest
+    """
+
+    def __init__(self, shards, max_events=None, max_bytes=None, policy="drop-oldest"):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.policy = policy
+        # limits are enforced here across shards, the shards themselves are unbounded
+        self.shards = [EventBuffer() for _ in range(shards)]
+        # threads are handed shards round robin, the first time they write
+        self._next_shard = itertools.count()
+        self._local = threading.local()
+        # events offered since the last swap, for sample-down
+        self._offered = itertools.count(1)
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self.shards[next(self._next_shard) % len(self.shards)]
+            self._local.shard = shard
+        return shard
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def bytes(self):
+        return sum(shard.bytes for shard in self.shards)
+
+    def _fits(self, size):
+        # totals are read without the shards' locks, so concurrent writers may
+        #  overshoot the limits by an event or so each
+        return (self.max_events is None or len(self) < self.max_events) and (
+            self.max_bytes is None or self.bytes + size <= self.max_bytes
+        )
+
+    def put(self, key, event, size=0):
+        """
+        Buffers an event, returns False if it was dropped instead
+        """
+        shard = self._shard()
+        offered = next(self._offered)
+        if not self._fits(size):
+            if (
+                self.policy == "drop-newest"
+                or self.max_events == 0
+                or (self.max_bytes is not None and size > self.max_bytes)
+                or (
+                    self.policy == "sample-down"
+                    and random.randrange(offered) >= len(self)
+                )
+            ):
+                shard.count_drop()
+                return False
+            while not self._fits(size):
+                victims = shard if len(shard) else max(self.shards, key=len)
+                if not victims.evict(at_random=self.policy == "sample-down"):
+                    break
+        return shard.put(key, event, size)
+
+    def swap(self):
+        self._offered = itertools.count(1)
+        events = []
+        for shard in self.shards:
+            events += shard.swap()
+        return events
+
+    def keys(self):
+        return [key for shard in self.shards for key in shard.keys()]
+
+    def values(self):
+        return [event for shard in self.shards for event in shard.values()]
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    def stats(self):
+        return _sum_stats(self.shards)
@@ -1,30 +1,54 @@
 #!/usr/bin/env python3
 
 import atexit
+import hashlib
 import os
 import threading
+import time
 import traceback
 from base64 import b64encode
 from contextlib import contextmanager
-from datetime import datetime
+from contextvars import ContextVar
+from datetime import datetime, timezone
 from importlib.metadata import version
 from urllib.parse import urlparse
 
 from dotenv import load_dotenv
 
 from .api import Api
+from .capture import (
+    CapturedRequest,
+    CapturedResponse,
+    EventBuffer,
+    ShardedEventBuffer,
+    ShardedRequestStore,
+    estimate_size,
+)
 from .constants import *
 from .helpers import (
+    cap_raw_body,
+    combine_truncation,
     decode_headers,
+    elapsed_ms,
     redact_all,
     redact_values,
     safe_decode,
     safe_parse_json,
+    truncate_body,
 )
 from .logger import Logger
-from .remote_config import get_vendor_endpoint_from_config, parse_remote_config_json
+from .remote_config import (
+    MatchCache,
+    get_vendor_endpoint_from_config,
+    load_remote_config_snapshot,
+    parse_remote_config_json,
+    save_remote_config_snapshot,
+    touch_remote_config_snapshot,
+)
 from .repeating_thread import RepeatingThread
+from .sampling import TailSampler, is_sampled, normalize_sample_rate
 from .vendors.aiohttp import patch as patch_aiohttp
+from .vendors.helpers import format_request_id
 from .vendors.http import patch as patch_http
 from .vendors.httpx import patch as patch_httpx
 from .vendors.requests import patch as patch_requests
@@ -32,6 +56,10 @@ from .vendors.urllib3 import patch as patch_urllib3
 
 load_dotenv()
 
+# Tags of the innermost `tagging` block, already merged with the blocks around it
+#  Each is a new dict that is never modified, so captured requests keep a reference
+CURRENT_TAGS = ContextVar("supergood_tags", default=None)
+
 
 class Client(object):
     def __init__(self):
@@ -49,8 +77,6 @@ class Client(object):
         self.uninitialized = False
         # This PID is used to detect when the client is running in a forked process
         self.main_pid = os.getpid()
-        # Storage for thread-local tags
-        self.thread_local = threading.local()
         self.base_url = base_url if base_url else DEFAULT_SUPERGOOD_BASE_URL
         self.telemetry_url = (
             telemetry_url if telemetry_url else DEFAULT_SUPERGOOD_TELEMETRY_URL
@@ -62,6 +88,9 @@ class Client(object):
 
         authorization = f"{client_id}:{client_secret_id}"
         self.time_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+        # Pairs the wall clock with perf_counter_ns, so captured perf_counter_ns
+        #  readings can be turned into timestamps later
+        self.clock_anchor = (time.time_ns(), time.perf_counter_ns())
 
         header_options = {
             "Accept": "application/json, text/plain, */*",
@@ -71,8 +100,8 @@ class Client(object):
             "supergood-api": "supergood-py",
             "supergood-api-version": version("supergood"),
         }
-        self.base_config = DEFAULT_SUPERGOOD_CONFIG
-        self.base_config.update(config)
+        # a copy, so one client's config never leaks into the defaults of the next
+        self.base_config = {**DEFAULT_SUPERGOOD_CONFIG, **config}
 
         # By default will spin up threads to handle flushing and config fetching
         #  can be changed by setting the appropriate config variable
@@ -90,6 +119,23 @@ class Client(object):
         self.log = Logger(self.__class__.__name__, self.base_config, self.api)
 
         self.remote_config = None
+        # Caches endpoint matches for the current remote config
+        self.match_cache = MatchCache(self.base_config["matchCacheSize"])
+        # Optionally start from the last config saved to disk, refreshed below as usual
+        self.remote_config_snapshot_path = None
+        if (
+            self.base_config["useRemoteConfig"]
+            and self.base_config["remoteConfigCacheDir"]
+        ):
+            # one snapshot per account and API, so clients sharing a directory don't collide
+            snapshot_key = hashlib.md5(
+                f"{self.base_url}:{client_id}".encode("utf-8")
+            ).hexdigest()
+            self.remote_config_snapshot_path = os.path.join(
+                self.base_config["remoteConfigCacheDir"],
+                f"supergood-config-{snapshot_key}.json",
+            )
+            self._load_config_snapshot()
         if auto_config and self.base_config["useRemoteConfig"]:
             self.remote_config_initial_pull = threading.Thread(
                 daemon=True, target=self._get_config
@@ -108,15 +154,52 @@ class Client(object):
 
         self.api.set_logger(self.log)
 
-        self._request_cache = {}
-        self._response_cache = {}
+        # Requests wait here for their response, bounded in age and size since
+        #  some never get one
+        capture_shards = max(1, int(self.base_config["captureShards"]))
+        request_cache_ttl = self.base_config["requestCacheTtl"]
+        self._request_cache = ShardedRequestStore(
+            capture_shards,
+            ttl=None if request_cache_ttl is None else request_cache_ttl * 1_000_000,
+            max_bytes=self.base_config["requestCacheByteLimit"],
+        )
+        # Completed events wait here for the next flush, bounded so that a slow
+        #  or unreachable sink can't grow it without limit
+        overflow_policy = self.base_config["eventBufferOverflowPolicy"]
+        if overflow_policy not in EventBuffer.POLICIES:
+            self.log.warning(f"Unknown eventBufferOverflowPolicy {overflow_policy}")
+            overflow_policy = "drop-oldest"
+        self._response_cache = ShardedEventBuffer(
+            capture_shards,
+            max_events=self.base_config["eventBufferMaxEvents"],
+            max_bytes=self.base_config["eventBufferByteLimit"],
+            policy=overflow_policy,
+        )
+        # In deferred decoding mode, requests and responses are cached raw
+        #  and only decoded, parsed and matched to endpoints when flushed
+        self.defer_decoding = self.base_config["deferDecoding"]
+        # (remote config, limits) last computed by _capture_limits
+        self._capture_limits_cache = None
+        self.sample_rate = normalize_sample_rate(self.base_config["sampleRate"])
+        self.tail_sampler = TailSampler.from_config(self.base_config)
 
         # Initialize patches here
         patch_requests(self._cache_request, self._cache_response)
-        patch_urllib3(self._cache_request, self._cache_response)
-        patch_http(self._cache_request, self._cache_response)
-        patch_aiohttp(self._cache_request, self._cache_response)
-        patch_httpx(self._cache_request, self._cache_response)
+        # streamed bodies are capped while they are read, nothing past the limit is kept
+        stream_limit = self.base_config["responseBodyByteLimit"]
+        patch_urllib3(
+            self._cache_request, self._cache_response, stream_limit=stream_limit
+        )
+        patch_http(self._cache_request, self._cache_response, stream_limit=stream_limit)
+        patch_aiohttp(
+            self._cache_request, self._cache_response, stream_limit=stream_limit
+        )
+        patch_httpx(
+            self._cache_request,
+            self._cache_response,
+            stream_limit=stream_limit,
+            request_limit=self.base_config["requestBodyByteLimit"],
+        )
 
         self.flush_thread = RepeatingThread(
             self.flush_cache, self.base_config["flushInterval"] / 1000
@@ -144,9 +227,9 @@ class Client(object):
             payload["metadata"].update({"payloadSize": size})
         if num_events:
             payload["numberOfEvents"] = num_events
-        tags = getattr(self.thread_local, "current_tags", None)
+        tags = CURRENT_TAGS.get()
         if tags:
-            payload["metadata"]["tags"] = self._format_tags(tags)
+            payload["metadata"]["tags"] = tags
         return payload
 
     def _should_ignore(
@@ -158,24 +241,18 @@ class Client(object):
         request_body=None,
         request_headers=None,
     ):
-        supergood_base_url = urlparse(self.base_url).hostname
-        supergood_telemetry_url = urlparse(self.telemetry_url).hostname
         # Logic:
         #  case 1: if we're in remote config mode and don't have one, always ignore
-        #  case 2/3: ignore internal supergood calls to avoid death spiral
-        #  case 4: ignore anything explicitly marked to ignore
+        #  case 2: ignore internal supergood calls and anything explicitly marked to ignore
         if (
-            (self.remote_config is None and self.base_config["useRemoteConfig"])
-            or host_domain == supergood_base_url
-            or host_domain == supergood_telemetry_url
-            or host_domain in self.base_config["ignoredDomains"]
-        ):
+            self.remote_config is None and self.base_config["useRemoteConfig"]
+        ) or self._ignores_host(host_domain):
             return True
 
         # At this point, if we're not in remote config mode we can safely return
-        #  we really only care about the ignored domains
+        #  we really only care about the ignored domains (and the global sample rate)
         if not self.base_config["useRemoteConfig"]:
-            return False
+            return not self._sample(metadata, self.sample_rate)
 
         vendor, endpoint = get_vendor_endpoint_from_config(
             self.remote_config,
@@ -183,6 +260,7 @@ class Client(object):
             method=method,
             request_body=request_body,
             request_headers=request_headers,
+            cache=self.match_cache,
         )
         if endpoint:
             # add endpoint and vendor to metadata for quicker redaction later
@@ -190,53 +268,193 @@ class Client(object):
             metadata["vendorId"] = vendor.vendor_id
             if endpoint.action.lower() == "ignore":
                 return True
-        return False
+            if endpoint.sample_rate is not None:
+                return not self._sample(metadata, endpoint.sample_rate)
+        return not self._sample(metadata, self.sample_rate)
 
-    def _cache_request(self, request_id, url, method, body, headers):
-        request = {}
+    def _ignores_host(self, host_domain):
+        """
+        Cheap checks that don't need the remote config: supergood's own calls
+        (to avoid a death spiral) and ignoredDomains
+        """
+        return (
+            host_domain == urlparse(self.base_url).hostname
+            or host_domain == urlparse(self.telemetry_url).hostname
+            or host_domain in self.base_config["ignoredDomains"]
+        )
+
+    def _capture_limits(self):
+        """
+        The largest request and response body byte limits configured, in the base
+        config or for any endpoint. Deferred captures are capped at these, since
+        their endpoint (and so their own limit) is only known on flush
+        """
+        remote_config = self.remote_config
+        cached = self._capture_limits_cache
+        if cached is not None and cached[0] is remote_config:
+            return cached[1]
+        request_limit = self.base_config["requestBodyByteLimit"]
+        response_limit = self.base_config["responseBodyByteLimit"]
+        for vendor in (remote_config or {}).values():
+            for endpoint in vendor.endpoints.values():
+                if request_limit is not None and endpoint.request_body_byte_limit:
+                    request_limit = max(request_limit, endpoint.request_body_byte_limit)
+                if response_limit is not None and endpoint.response_body_byte_limit:
+                    response_limit = max(
+                        response_limit, endpoint.response_body_byte_limit
+                    )
+        limits = (request_limit, response_limit)
+        self._capture_limits_cache = (remote_config, limits)
+        return limits
+
+    def _sample(self, metadata, rate):
+        """
+        Decides whether to keep an event sampled at `rate`
+        Kept events record their rate in metadata, so counts can be re-weighted
+        """
+        if rate >= 1:
+            return True
+        if not is_sampled(rate):
+            return False
+        metadata["sampleRate"] = rate
+        return True
+
+    def _get_endpoint(self, metadata):
+        """
+        Returns the EndpointConfiguration recorded in an event's metadata, if any
+        """
+        vendor_id = metadata.get("vendorId")
+        if not vendor_id or not self.remote_config:
+            return None
+        vendor = self.remote_config.get(vendor_id)
+        return vendor.endpoints.get(metadata.get("endpointId")) if vendor else None
+
+    def _body_limit(self, metadata, section):
+        """
+        Byte limit for `section` ("requestBody" or "responseBody") of an event,
+        the endpoint in metadata may override the base config's
+        """
+        endpoint = self._get_endpoint(metadata)
+        if section == "requestBody":
+            limit = endpoint.request_body_byte_limit if endpoint else None
+            if limit is None:
+                limit = self.base_config["requestBodyByteLimit"]
+        else:
+            limit = endpoint.response_body_byte_limit if endpoint else None
+            if limit is None:
+                limit = self.base_config["responseBodyByteLimit"]
+        return limit
+
+    def _retained_size(self, body, metadata, section):
+        """
+        Roughly how many bytes of a raw body an event keeps, once it is truncated
+        to its limit, for bounding the caches. Not decoded or parsed, so a gzipped
+        body counts as its limit
+        """
+        if not self.base_config[
+            "logRequestBody" if section == "requestBody" else "logResponseBody"
+        ]:
+            return 0
+        limit = self._body_limit(metadata, section)
+        size = estimate_size(body)
+        if limit is None:
+            return size
+        if isinstance(body, (bytes, bytearray)) and body[:2] == GZIP_START_BYTES:
+            return limit
+        return min(size, limit)
+
+    def _parse_body(self, body, metadata, section, stream_truncation=None):
+        """
+        Decodes and parses a captured body, after truncating it to the byte limit
+        for `section` ("requestBody" or "responseBody"). The endpoint in metadata
+        may override the limit. Truncation is recorded in metadata
+        stream_truncation: set when a vendor already cut the body off while streaming it
+        """
+        body, truncation = truncate_body(body, self._body_limit(metadata, section))
+        # the body may have been cut down further, but its full size is the stream's
+        truncation = combine_truncation(stream_truncation, truncation)
+        if truncation:
+            metadata.setdefault("truncated", {})[section] = truncation
+            if isinstance(body, (bytes, bytearray)):
+                # e.g. a capped gzip body, which decompressed within the limit
+                body = bytes(body).decode("utf-8", errors="ignore")
+            # A truncated body won't parse as JSON, don't try
+            return body
+        return safe_parse_json(safe_decode(body))
+
+    def _current_tags(self):
+        return CURRENT_TAGS.get()
+
+    def _tail_sample(self, metadata, status, elapsed):
+        """
+        Runs a completed event through the tail sampler, if there is one
+        Events kept by sampling multiply their rate into metadata["sampleRate"]
+        """
+        if self.tail_sampler is None:
+            return True
+        keep, sampled = self.tail_sampler.keep(
+            status, elapsed, metadata.get("endpointId")
+        )
+        if keep and sampled:
+            metadata["sampleRate"] = (
+                metadata.get("sampleRate", 1.0) * self.tail_sampler.sample_rate
+            )
+        return keep
+
+    def _cache_request(
+        self,
+        request_id,
+        url,
+        method,
+        body,
+        headers,
+        requested_at=None,
+        request_truncation=None,
+    ):
+        """
+        requested_at: time.perf_counter_ns() when the request was sent, for vendors
+          that only capture it later. Defaults to now
+        request_truncation: set by streaming vendors that had to cut the body off
+          while it was sent, as {"size", "retained"}
+        """
+        # perf_counter_ns is monotonic and cheap, wall clock times are derived
+        #  from it (and formatted) at flush time
+        if requested_at is None:
+            requested_at = time.perf_counter_ns()
         try:
-            url = safe_decode(url)  # we do this first so the urlparse isn't also bytes
-            host_domain = urlparse(url).hostname
-            safe_headers = (
-                {} if headers is None else dict(headers)
-            )  # sometimes headers is not json serializable
-            request["metadata"] = {}
-            # Check that we should cache the request
-            parsed_method = safe_decode(method)
-            if not self._should_ignore(
-                host_domain,
-                request["metadata"],  # we store endpoint id in metadata
-                url=url,
-                method=parsed_method,
-                request_body=body,
-                request_headers=safe_headers,
-            ):
-                now = datetime.utcnow().strftime(self.time_format)
-                parsed_url = urlparse(url)
-                filtered_body = (
-                    ""
-                    if not self.base_config["logRequestBody"]
-                    else safe_parse_json(safe_decode(body))
+            if self.defer_decoding:
+                # Record only what we were given, capped to the largest limit
+                #  configured. Everything else happens on flush
+                if self._ignores_host(urlparse(safe_decode(url)).hostname):
+                    return
+                body, truncation = cap_raw_body(body, self._capture_limits()[0])
+                captured = CapturedRequest(
+                    request_id,
+                    url,
+                    method,
+                    body,
+                    headers,
+                    requested_at,
+                    self._current_tags(),
+                    combine_truncation(request_truncation, truncation),
                 )
-                filtered_headers = (
-                    {}
-                    if (not self.base_config["logRequestHeaders"] or headers is None)
-                    else decode_headers(safe_headers)
+                self._request_cache.put(request_id, captured, estimate_size(url, body))
+                return
+            request = self._build_request(
+                request_id,
+                url,
+                method,
+                body,
+                headers,
+                requested_at,
+                self._current_tags(),
+                request_truncation,
+            )
+            if request:
+                size = estimate_size(url) + self._retained_size(
+                    body, request["metadata"], "requestBody"
                 )
-                request["request"] = {
-                    "id": request_id,
-                    "method": parsed_method,
-                    "url": url,
-                    "body": filtered_body,
-                    "headers": filtered_headers,
-                    "path": parsed_url.path,
-                    "search": parsed_url.query,
-                    "requestedAt": now,
-                }
-                tags = getattr(self.thread_local, "current_tags", None)
-                if tags:
-                    request["metadata"]["tags"] = self._format_tags(tags)
-                self._request_cache[request_id] = request
+                self._request_cache.put(request_id, request, size)
         except Exception:
             payload = self._build_log_payload(
                 urls=[url],
@@ -244,6 +462,67 @@ class Client(object):
             trace = "".join(traceback.format_exc())
             self.log.error(ERRORS["CACHING_REQUEST"], trace, payload)
 
+    def _build_request(
+        self,
+        request_id,
+        url,
+        method,
+        body,
+        headers,
+        requested_at,
+        tags,
+        request_truncation=None,
+    ):
+        """
+        Decodes and parses a captured request
+        requested_at: time.perf_counter_ns() when the request was captured
+        Returns the request cache entry, or None if the request should be ignored
+        """
+        request = {}
+        url = safe_decode(url)  # we do this first so the urlparse isn't also bytes
+        host_domain = urlparse(url).hostname
+        safe_headers = (
+            {} if headers is None else dict(headers)
+        )  # sometimes headers is not json serializable
+        request["metadata"] = {}
+        # Check that we should cache the request
+        parsed_method = safe_decode(method)
+        if self._should_ignore(
+            host_domain,
+            request["metadata"],  # we store endpoint id in metadata
+            url=url,
+            method=parsed_method,
+            request_body=body,
+            request_headers=safe_headers,
+        ):
+            return None
+        parsed_url = urlparse(url)
+        filtered_body = (
+            ""
+            if not self.base_config["logRequestBody"]
+            else self._parse_body(
+                body, request["metadata"], "requestBody", request_truncation
+            )
+        )
+        filtered_headers = (
+            {}
+            if (not self.base_config["logRequestHeaders"] or headers is None)
+            else decode_headers(safe_headers)
+        )
+        request["request"] = {
+            "id": request_id,
+            "method": parsed_method,
+            "url": url,
+            "body": filtered_body,
+            "headers": filtered_headers,
+            "path": parsed_url.path,
+            "search": parsed_url.query,
+            "requestedAt": requested_at,  # formatted on flush
+        }
+        if tags:
+            request["metadata"]["tags"] = tags
+        return request
+
     def _cache_response(
         self,
         request_id,
@@ -251,53 +530,211 @@ class Client(object):
         response_headers,
         response_status,
         response_status_text,
+        first_byte_ns=None,
+        response_truncation=None,
+        connection_reused=None,
     ) -> None:
-        request, response = {}, {}
+        """
+        first_byte_ns: time.perf_counter_ns() when the response headers arrived,
+          for vendors that can tell
+        response_truncation: set by streaming vendors that had to cut the body off
+          while it was read, as {"size", "retained"}
+        connection_reused: whether the request went out on a pooled connection,
+          for vendors that can tell
+        """
+        responded_at = time.perf_counter_ns()
+        request = {}
         try:
             # Ignored domains are not in the request cache, so this yields None
-            request = self._request_cache.pop(request_id, None)
-            if request:
-                body = safe_parse_json(safe_decode(response_body))
-                filtered_body = "" if not self.base_config["logResponseBody"] else body
-                filtered_headers = (
-                    {}
-                    if not self.base_config["logResponseHeaders"]
-                    else decode_headers(dict(response_headers))
+            request, request_size = self._request_cache.take(request_id)
+            if not request:
+                return
+            if isinstance(request, CapturedRequest):
+                # endpoint isn't matched yet, tail sampling happens on flush
+                response_body, truncation = cap_raw_body(
+                    response_body, self._capture_limits()[1]
                 )
-                response = {
-                    "body": filtered_body,
-                    "headers": filtered_headers,
-                    "status": response_status,
-                    "statusText": safe_decode(response_status_text),
-                    "respondedAt": datetime.utcnow().strftime(self.time_format),
-                }
-                if os.getpid() == self.main_pid:
-                    # If we're in the main thread, push to the cache
-                    self._response_cache[request_id] = {
-                        "request": request["request"],
-                        "response": response,
-                        "metadata": request.get("metadata", {}),
-                    }
+                event = CapturedResponse(
+                    request,
+                    response_body,
+                    response_headers,
+                    response_status,
+                    response_status_text,
+                    responded_at,
+                    first_byte_ns,
+                    combine_truncation(response_truncation, truncation),
+                    connection_reused,
+                )
+            else:
+                elapsed = elapsed_ms(request["request"]["requestedAt"], responded_at)
+                if not self._tail_sample(request["metadata"], response_status, elapsed):
+                    return
+                event = self._build_event(
+                    request,
+                    response_body,
+                    response_headers,
+                    response_status,
+                    response_status_text,
+                    responded_at,
+                    first_byte_ns,
+                    response_truncation,
+                    connection_reused,
+                )
+            if os.getpid() == self.main_pid:
+                # If we're in the main thread, push to the cache
+                if isinstance(event, CapturedResponse):
+                    # already capped to what is kept
+                    response_size = estimate_size(response_body)
                 else:
-                    # Otherwise, flush synchronously
-                    self.sync_flush_cache(
-                        [
-                            {
-                                "request": request["request"],
-                                "response": response,
-                                "metadata": request.get("metadata", {}),
-                            }
-                        ]
+                    response_size = self._retained_size(
+                        response_body, event["metadata"], "responseBody"
                     )
+                self._response_cache.put(
+                    request_id, event, request_size + response_size
+                )
+            else:
+                # Otherwise, flush synchronously
+                self.sync_flush_cache([event])
 
         except Exception:
             url = None
-            if request and request.get("request", None):
+            if isinstance(request, CapturedRequest):
+                url = request.url
+            elif request and request.get("request", None):
                 url = request.get("request").get("url")
             payload = self._build_log_payload(urls=[url] if url else [])
             trace = "".join(traceback.format_exc())
             self.log.error(ERRORS["CACHING_RESPONSE"], trace, payload)
 
+    def _build_event(
+        self,
+        request,
+        response_body,
+        response_headers,
+        response_status,
+        response_status_text,
+        responded_at,
+        first_byte_ns=None,
+        response_truncation=None,
+        connection_reused=None,
+    ):
+        """
+        Decodes and parses a captured response
+        Returns the event combining it with its already built request
+        """
+        metadata = request.get("metadata", {})
+        if connection_reused is not None:
+            metadata["connectionReused"] = connection_reused
+        filtered_body = (
+            ""
+            if not self.base_config["logResponseBody"]
+            else self._parse_body(
+                response_body, metadata, "responseBody", response_truncation
+            )
+        )
+        filtered_headers = (
+            {}
+            if not self.base_config["logResponseHeaders"]
+            else decode_headers(dict(response_headers))
+        )
+        requested_at = request["request"]["requestedAt"]
+        response = {
+            "body": filtered_body,
+            "headers": filtered_headers,
+            "status": response_status,
+            "statusText": safe_decode(response_status_text),
+            "respondedAt": responded_at,  # formatted on flush
+            "duration": elapsed_ms(requested_at, responded_at),
+        }
+        if first_byte_ns is not None:
+            response["timeToFirstByte"] = elapsed_ms(requested_at, first_byte_ns)
+        return {
+            "request": request["request"],
+            "response": response,
+            "metadata": metadata,
+        }
+
+    def _format_timestamp(self, ns):
+        """
+        Converts a time.perf_counter_ns() reading to a wall clock timestamp string
+        """
+        wall_anchor, perf_anchor = self.clock_anchor
+        wall_ns = wall_anchor + (ns - perf_anchor)
+        return (
+            datetime.fromtimestamp(wall_ns // 1_000_000_000, tz=timezone.utc)
+            .replace(microsecond=(wall_ns // 1000) % 1_000_000)
+            .strftime(self.time_format)
+        )
+
+    def _render_event(self, event):
+        """
+        Returns a copy of `event` with its request id and timestamps formatted
+        The copy leaves cache entries untouched, in-flight requests may still get a response
+        """
+        event = dict(event)
+        request = event.get("request")
+        if request:
+            request = dict(request)
+            request["id"] = format_request_id(request["id"])
+            if isinstance(request.get("requestedAt"), int):
+                request["requestedAt"] = self._format_timestamp(request["requestedAt"])
+            event["request"] = request
+        response = event.get("response")
+        if response and isinstance(response.get("respondedAt"), int):
+            response = dict(response)
+            response["respondedAt"] = self._format_timestamp(response["respondedAt"])
+            event["response"] = response
+        return event
+
+    def _materialize(self, entries):
+        """
+        Builds events from records captured in deferred decoding mode, dropping
+        any that should be ignored, and formats the ids and timestamps of every event
+        """
+        events = []
+        for entry in entries:
+            if isinstance(entry, CapturedResponse):
+                captured = entry.request
+            elif isinstance(entry, CapturedRequest):
+                captured = entry
+            else:
+                events.append(self._render_event(entry))
+                continue
+            try:
+                event = self._build_request(
+                    captured.request_id,
+                    captured.url,
+                    captured.method,
+                    captured.body,
+                    captured.headers,
+                    captured.requested_at,
+                    captured.tags,
+                    captured.truncation,
+                )
+                if event and isinstance(entry, CapturedResponse):
+                    elapsed = elapsed_ms(captured.requested_at, entry.responded_at)
+                    if not self._tail_sample(event["metadata"], entry.status, elapsed):
+                        continue
+                    event = self._build_event(
+                        event,
+                        entry.body,
+                        entry.headers,
+                        entry.status,
+                        entry.status_text,
+                        entry.responded_at,
+                        entry.first_byte_at,
+                        entry.truncation,
+                        entry.connection_reused,
+                    )
+            except Exception:
+                payload = self._build_log_payload(urls=[safe_decode(captured.url)])
+                trace = "".join(traceback.format_exc())
+                self.log.error(ERRORS["CACHING_RESPONSE"], trace, payload)
+                continue
+            if event:
+                events.append(self._render_event(event))
+        return events
+
     def close(self) -> None:
         self.log.debug("Closing client auto-flush, force flushing remaining cache")
         self.flush_thread.cancel()
@@ -316,8 +753,20 @@ class Client(object):
             raw_config = self.api.get_config()
             if raw_config is not None:
                 # non-exception erroring / warning is handled by the API
-                self.remote_config = parse_remote_config_json(raw_config)
+                remote_config = parse_remote_config_json(
+                    raw_config, previous=self.remote_config
+                )
+                if remote_config is not self.remote_config:
+                    self.remote_config = remote_config
+                    self.match_cache.invalidate()
+                    self._save_config_snapshot(raw_config)
+                else:
+                    self._save_config_snapshot(None)
+            elif self.api.config_not_modified:
+                self._save_config_snapshot(None)
         except Exception:
+            # make sure the next pull returns the full config
+            self.api.config_etag = None
             if self.remote_config:
                 self.log.warning("Failed to update remote config")
             else:
@@ -325,6 +774,41 @@ class Client(object):
                 trace = "".join(traceback.format_exc())
                 self.log.error(ERRORS["FETCHING_CONFIG"], trace, payload)
 
+    def _load_config_snapshot(self) -> None:
+        try:
+            snapshot = load_remote_config_snapshot(
+                self.remote_config_snapshot_path,
+                max_age=self.base_config["remoteConfigCacheMaxAge"] / 1000,
+            )
+            if snapshot is not None:
+                raw_config, etag = snapshot
+                self.remote_config = parse_remote_config_json(raw_config)
+                # lets the first pull return a 304 if the snapshot is still current
+                self.api.config_etag = etag
+                self.log.debug("Loaded remote config snapshot")
+        except Exception:
+            payload = self._build_log_payload()
+            trace = "".join(traceback.format_exc())
+            self.log.error(ERRORS["LOADING_CONFIG_SNAPSHOT"], trace, payload)
+
+    def _save_config_snapshot(self, raw_config) -> None:
+        """
+        Writes `raw_config` to the snapshot file, or just refreshes the snapshot's age
+        if raw_config is None (i.e. the config has not changed)
+        """
+        if not self.remote_config_snapshot_path:
+            return
+        try:
+            if raw_config is None:
+                touch_remote_config_snapshot(self.remote_config_snapshot_path)
+            else:
+                save_remote_config_snapshot(
+                    self.remote_config_snapshot_path, raw_config, self.api.config_etag
+                )
+        except Exception:
+            # the snapshot only speeds up startup, keep running without it
+            self.log.warning(ERRORS["SAVING_CONFIG_SNAPSHOT"])
+
     def _take_lock(self, block=False) -> bool:
         return self.flush_lock.acquire(blocking=block)
 
@@ -349,23 +833,35 @@ class Client(object):
             self.log.info("Flush already in progress, skipping")
             return
         # FLUSH LOCK PROTECTION START
-        response_keys = []
-        request_keys = []
+        num_responses = 0
+        num_requests = 0
         try:
-            response_keys = list(self._response_cache.keys())
-            request_keys = list(self._request_cache.keys())
-            # If there are no responses in cache, just exit
-            if len(response_keys) == 0 and not force:
+            # Requests that never got a response are dropped, or posted without one
+            expired = self._request_cache.expire()
+            if not self.base_config["emitExpiredRequests"]:
+                expired = []
+            # Take the buffered events in one swap, request threads carry on
+            #  filling an empty buffer while this batch is posted
+            data = self._response_cache.swap()
+            num_responses = len(data)
+            # When forcing, pending requests are posted too
+            if force:
+                pending = self._request_cache.drain()
+                num_requests = len(pending)
+                data += pending
+            else:
+                num_requests = len(self._request_cache)
+            # If there's nothing to post, exit here
+            if len(data) == 0 and len(expired) == 0:
                 return
 
-            # If we're forcing a flush but there's nothing in the cache, exit here
-            if force and len(response_keys) == 0 and len(request_keys) == 0:
+            data = self._materialize(data)
+            for event in self._materialize(expired):
+                event["metadata"]["expired"] = True
+                data.append(event)
+            if len(data) == 0:
+                # everything captured was ignored
                 return
-
-            data = list(self._response_cache.values())
-
-            if force:
-                data += list(self._request_cache.values())
             try:
                 # In force redact all mode, always force redact everything
                 if self.base_config["forceRedactAll"]:
@@ -379,6 +875,7 @@ class Client(object):
                         data,
                         self.remote_config,
                         self.base_config,
+                        self.match_cache,
                     )
                     if to_delete:
                         data = [
@@ -397,10 +894,23 @@ class Client(object):
             else:  # Only post if no exceptions
                 self.log.debug(f"Flushing {len(data)} items")
                 try:
+                    match_cache_stats = self.match_cache.stats()
+                    request_cache_stats = self._request_cache.stats()
+                    event_buffer_stats = self._response_cache.stats()
                     self.api.post_telemetry(
                         {
-                            "numResponseCacheKeys": len(response_keys),
-                            "numRequestCacheKeys": len(request_keys),
+                            "numResponseCacheKeys": num_responses,
+                            "numRequestCacheKeys": num_requests,
+                            "requestCacheBytes": request_cache_stats["bytes"],
+                            "requestCacheEvictions": request_cache_stats["evictions"],
+                            "requestCacheExpirations": request_cache_stats[
+                                "expirations"
+                            ],
+                            "eventBufferBytes": event_buffer_stats["bytes"],
+                            "eventBufferDrops": event_buffer_stats["dropped"],
+                            "matchCacheHits": match_cache_stats["hits"],
+                            "matchCacheMisses": match_cache_stats["misses"],
+                            "matchCacheBypasses": match_cache_stats["bypasses"],
                         }
                     )
                 except Exception as e:
@@ -422,11 +932,6 @@ class Client(object):
                 payload = self._build_log_payload()
             self.log.error(ERRORS["POSTING_EVENTS"], trace, payload)
         finally:  # always occurs, even from internal returns
-            for response_key in response_keys:
-                self._response_cache.pop(response_key, None)
-            if force:
-                for request_key in request_keys:
-                    self._request_cache.pop(request_key, None)
             self.flush_lock.release()
             # FLUSH LOCK PROTECTION END
 
@@ -445,11 +950,14 @@ class Client(object):
             return
 
         # don't worry about the flush lock because each flush is only handling one event
+        data = self._materialize(data)
+        if len(data) == 0:
+            return
         try:
             # don't worry about anything on the cache except for the data provided to us
             try:
                 if self.base_config["forceRedactAll"]:
-                    redact_all(data)
+                    redact_all(data, self.remote_config, by_default=False)
                 elif self.base_config["redactByDefault"]:
                     redact_all(data, self.remote_config, by_default=True)
                 elif self.base_config["useRemoteConfig"]:
@@ -457,6 +965,7 @@ class Client(object):
                         data,
                         self.remote_config,
                         self.base_config,
+                        self.match_cache,
                     )
                     if to_delete:
                         data = [
@@ -489,13 +998,6 @@ class Client(object):
                 payload = self._build_log_payload()
                 self.log.error(ERRORS["POSTING_EVENTS"], trace, payload)
 
-    def _format_tags(self, tags):
-        # takes a list of tags (dicts) and rolls them up into one dictionary
-        new_tags = {}
-        for tagset in tags:
-            new_tags.update(tagset)
-        return new_tags
-
     @contextmanager
     def tagging(self, tags):
         # tags should be a KV dict of primitives, e.g. {'customer': 'Patrick'}
@@ -508,12 +1010,11 @@ class Client(object):
         #  wrap non-dicts
         if not isinstance(tags, dict):
             tags = {"tags": tags}
-        current_tags = getattr(self.thread_local, "current_tags", None)
-        if current_tags:
-            self.thread_local.current_tags.append(tags)
-        else:
-            self.thread_local.current_tags = [tags]
+        # Tags follow the current context, so concurrent asyncio tasks on one thread
+        #  each see their own. They are merged once here, not on every capture
+        outer_tags = CURRENT_TAGS.get()
+        token = CURRENT_TAGS.set({**outer_tags, **tags} if outer_tags else dict(tags))
         try:
             yield
         finally:
-            self.thread_local.current_tags.pop()
+            CURRENT_TAGS.reset(token)
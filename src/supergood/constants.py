@@ -5,6 +5,8 @@ SIGNALS = [
     signal.SIGINT,
 ]
 REQUEST_ID_KEY = "_supergood_request_id"
+FIRST_BYTE_KEY = "_supergood_first_byte_ns"
+RESPONSE_CAPTURE_KEY = "_supergood_capture"
 GZIP_START_BYTES = b"\x1f\x8b"
 DEFAULT_SUPERGOOD_BYTE_LIMIT = 500000
 DEFAULT_SUPERGOOD_BASE_URL = "https://api.supergood.ai/"
@@ -22,10 +24,30 @@ DEFAULT_SUPERGOOD_CONFIG = {
     "logRequestBody": True,
     "logResponseHeaders": True,
     "logResponseBody": True,
+    "requestBodyByteLimit": DEFAULT_SUPERGOOD_BYTE_LIMIT,  # larger bodies are truncated
+    "responseBodyByteLimit": DEFAULT_SUPERGOOD_BYTE_LIMIT,
+    "sampleRate": 1.0,  # fraction of events to keep, endpoints may override it
+    "tailSampleRate": 1.0,  # fraction of completed events to keep that match no rule below
+    "tailSampleStatusClasses": [5],  # always keep these status classes, e.g. 5 for 5xx
+    "tailSampleLatencyThreshold": None,  # always keep responses slower than this (ms)
+    "tailSampleEndpointIds": [],  # always keep events for these endpoints
+    # requests still waiting on a response after this (ms) are expired on flush,
+    #  including ones whose response is still streaming. Set it above your longest streams
+    "requestCacheTtl": 3600000,
+    "requestCacheByteLimit": 50000000,  # oldest waiting requests are evicted once they add up to more than this
+    "emitExpiredRequests": False,  # post expired requests as events without a response, instead of dropping them
+    "eventBufferMaxEvents": 10000,  # most completed events to hold between flushes
+    "eventBufferByteLimit": 50000000,  # most (approximate) bytes of completed events to hold between flushes
+    "eventBufferOverflowPolicy": "drop-oldest",  # drop-newest, drop-oldest or sample-down once the buffer is full
+    "captureShards": 16,  # request/event caches are split this many ways, so request threads rarely contend
+    "deferDecoding": False,  # capture raw requests/responses, decode and parse them on flush
     "ignoreRedaction": False,  # ignores redaction. Lowest priority flag
     "useRemoteConfig": True,
     "runThreads": True,
     "redactByDefault": False,
+    "matchCacheSize": 4096,  # number of (method, url) endpoint matches to remember
+    "remoteConfigCacheDir": None,  # directory to snapshot the remote config in, off when unset
+    "remoteConfigCacheMaxAge": 86400000,  # snapshots older than this are not loaded
 }
 
 ERRORS = {
@@ -35,6 +57,8 @@ ERRORS = {
     "POSTING_EVENTS": "Error Posting Events",
     "POSTING_ERRORS": "Error Posting Errors",
     "FETCHING_CONFIG": "Error Fetching Config",
+    "LOADING_CONFIG_SNAPSHOT": "Error Loading Remote Config Snapshot",
+    "SAVING_CONFIG_SNAPSHOT": "Error Saving Remote Config Snapshot",
     "WRITING_TO_DISK": "Error writing to disk",
     "TEST_ERROR": "Test Error for Testing Purposes",
     "UNINITIALIZED": "Client not properly initialized",
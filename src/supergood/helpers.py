@@ -1,15 +1,17 @@
 import gzip
 import hashlib
 import json
-import re
 import sys
+import zlib
 from base64 import b64encode
-from typing import Tuple
-
-from pydash import get, set_
 
 from .constants import ERRORS, GZIP_START_BYTES
-from .remote_config import get_allowed_keys, get_vendor_endpoint_from_config
+from .remote_config import (
+    RedactionNode,
+    compile_redaction_plan,
+    get_allowed_keys,
+    get_vendor_endpoint_from_config,
+)
 
 
 def hash_value(input):
@@ -22,45 +24,38 @@ def hash_value(input):
     return b64encode(hash.digest()).decode("utf-8")
 
 
-def get_with_exists(obj, key) -> Tuple[any, bool]:
-    """
-    obj: a dictionary object, usually a request/response
-    key: A keypath to test, in the form key1.key2[0].key3
-
-    If the key path is valid, returns
-    (value, True)
-    otherwise returns
-    (None, False)
-    """
-    dummy = object()
-    test = get(obj, key, dummy)
-    # If we get the default value back, the keypath does not exist
-    if test != dummy:
-        return test, True
-    else:
-        return None, False
-
-
-def recursive_size(obj, seen=set(), include_overhead=False):
+def recursive_size(obj, include_overhead=False):
     """
     NB: Assumes it's operating on a JSON response. Not for general use
     By default does NOT include the overhead of dict overhead, just the sizes of keys and values
+    Walks iteratively, and only keeps state for the duration of the call
     """
-    obj_id = id(obj)
-    if obj_id in seen:
-        return 0
-    seen.add(obj_id)
     size = 0
-    if isinstance(obj, dict):
-        if include_overhead:
-            size += sys.getsizeof(obj)
-        size += sum([recursive_size(v, seen, include_overhead) for v in obj.values()])
-        size += sum([recursive_size(k, seen, include_overhead) for k in obj.keys()])
-    else:
-        size = sys.getsizeof(obj)
+    # guards against cycles, which JSON can't have but hand-built dicts might
+    seen = set()
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            if id(item) in seen:
+                continue
+            seen.add(id(item))
+            if include_overhead:
+                size += sys.getsizeof(item)
+            size += sum(map(sys.getsizeof, item.keys()))
+            stack.extend(item.values())
+        else:
+            size += sys.getsizeof(item)
     return size
 
 
+def elapsed_ms(start_ns, end_ns):
+    """
+    Milliseconds between two time.perf_counter_ns() readings
+    """
+    return (end_ns - start_ns) / 1_000_000
+
+
 def describe_data(data):
     """
     data: a portion of a JSON response
@@ -90,48 +85,44 @@ def describe_data(data):
         raise Exception()
 
 
-def transform_key(key, replace):
-    split = key["keyPath"].split(".")
-    if "[" in split[0]:
-        loc = split[0].find("[")
-        new_replace = replace + split[0][loc:]
-        return ".".join([new_replace] + split[1:])
-    else:
-        return ".".join([replace] + split[1:])
-
-
-def redact_all_helper(elem, path=[], allowed=[]):
-    skeys = []
-    if isinstance(elem, dict):
-        for key, value in elem.items():
-            new_skeys = redact_all_helper(value, path + [str(key)], allowed)
-            skeys += new_skeys
-    elif isinstance(elem, list):
-        for index, item in enumerate(elem):
-            if len(path) == 0:
-                # This should not happen given the implementation
-                new_path = f"[{str(index)}]"
-            else:
-                new_path = path[:]
-                new_path[-1] = new_path[-1] + f"[{str(index)}]"
-            new_skeys = redact_all_helper(item, new_path, allowed)
-            skeys += new_skeys
-    else:
-        key_path = ".".join(path)
-        # check to see if the generic keypath (no array indexes) is an allowed key
-        generic_keypath = re.sub(r"\[\d+\]", "[]", key_path)
-        if generic_keypath in allowed:
-            # do not mark allowed keys to be redacted
-            return []
-        (data_type, data_length) = describe_data(elem)
-        skeys.append(
-            {
-                "keyPath": key_path,
-                "type": data_type,
-                "length": data_length,
-            }
-        )
-    return skeys
+def _redact_all_section(container, key, key_path, allowed, skeys):
+    """
+    Iteratively redacts every leaf value under container[key], in-place
+    key_path: standardized keypath of container[key], e.g. responseBody
+    allowed: generic keypaths (array indexes replaced with []) which are not redacted
+    metadata for each redacted leaf is appended to skeys
+    """
+    # Generic keypaths are only needed to check against allowed keys
+    generic_path = key_path if allowed else None
+    # Children are pushed in reverse so values are visited in document order
+    stack = [(container, key, key_path, generic_path)]
+    while stack:
+        parent, key, key_path, generic_path = stack.pop()
+        value = parent[key]
+        if isinstance(value, dict):
+            for child_key in reversed(list(value.keys())):
+                stack.append(
+                    (
+                        value,
+                        child_key,
+                        f"{key_path}.{child_key}",
+                        f"{generic_path}.{child_key}" if allowed else None,
+                    )
+                )
+        elif isinstance(value, list):
+            generic_child_path = f"{generic_path}[]" if allowed else None
+            for index in range(len(value) - 1, -1, -1):
+                stack.append((value, index, f"{key_path}[{index}]", generic_child_path))
+        elif not allowed or generic_path not in allowed:
+            (data_type, data_length) = describe_data(value)
+            parent[key] = None
+            skeys.append(
+                {
+                    "keyPath": key_path,
+                    "type": data_type,
+                    "length": data_length,
+                }
+            )
 
 
 def redact_all(input_array, remote_config, by_default=False):
@@ -148,180 +139,110 @@ def redact_all(input_array, remote_config, by_default=False):
     """
     for data in input_array:
         metadata = data.get("metadata", {})
-        allowed_keys = []
+        allowed_keys = frozenset()
         if "endpointId" in metadata and "vendorId" in metadata and by_default:
             # If we know about the endpoint, and are redacting by default, check for any allowed keys
             allowed_keys = get_allowed_keys(
                 remote_config, metadata["vendorId"], metadata["endpointId"]
             )
         skeys = []
-        if data.get("request", None):
-            req = data.get("request")
-            if req.get("body", None):
-                new_skeys = redact_all_helper(
-                    req.get("body"), path=["requestBody"], allowed=allowed_keys
-                )
-                for key in new_skeys:
-                    actual = transform_key(key, "request.body")
-                    set_(data, actual, None)
-                skeys += new_skeys
-            if req.get("headers", None):
-                new_skeys = redact_all_helper(
-                    req.get("headers"),
-                    path=["requestHeaders"],
-                    allowed=allowed_keys,
-                )
-                for key in new_skeys:
-                    actual = transform_key(key, "request.headers")
-                    set_(data, actual, None)
-                skeys += new_skeys
-        if data.get("response", None):
-            resp = data.get("response")
-            if resp.get("body", None):
-                new_skeys = redact_all_helper(
-                    resp.get("body"),
-                    path=["responseBody"],
-                    allowed=allowed_keys,
-                )
-                for key in new_skeys:
-                    actual = transform_key(key, "response.body")
-                    set_(data, actual, None)
-                skeys += new_skeys
-            if resp.get("headers", None):
-                new_skeys = redact_all_helper(
-                    resp.get("headers"),
-                    path=["responseHeaders"],
-                    allowed=allowed_keys,
-                )
-                for key in new_skeys:
-                    actual = transform_key(key, "response.headers")
-                    set_(data, actual, None)
-                skeys += new_skeys
+        for part1, part2, key_path in (
+            ("request", "body", "requestBody"),
+            ("request", "headers", "requestHeaders"),
+            ("response", "body", "responseBody"),
+            ("response", "headers", "responseHeaders"),
+        ):
+            section = data.get(part1, None)
+            if section and section.get(part2, None):
+                _redact_all_section(section, part2, key_path, allowed_keys, skeys)
         if "metadata" not in data:
             data["metadata"] = {}
         data["metadata"].update({"sensitiveKeys": skeys})
 
 
-def deep_redact_(input, keypath, action):
+def _redact_node(parent, key, node, key_path, limit, skeys):
     """
-    input: a request or response json blob to be redacted
-    keypath: a keypath operating on an array, i.e. containing []
-    action: the action to take on that values at that keypath
-
-    To redact a key that is present in one or many response array objects, e.g.
-    `response.body.added[].payment_instruments[].number`
-    you have to iterate over both (all) arrays to collect all the keys
-    that need to be redacted.
-
-    This function redacts (removes) all `keypath` keys in-place on `input`
-    and returns metadata about each extracted key, which Supergood uses for schema
-    anomaly detection.
+    parent[key]: the value at the location `node`
+    key_path: standardized keypath of that value, e.g. responseBody.items[3].card
+    limit: sensitive keys at or after this ordinal have already been cut off,
+      because a key earlier in the config redacted a value containing them
+    skeys: (ordinal, metadata) for each redacted value are appended to this list
     """
-    all_keys = []
-    for key_segment in keypath.split("."):
-        if key_segment.endswith("[]"):
-            key_name = key_segment[0:-2]
-            new_keys = []
-            for keypart in all_keys:
-                arr = get(input, ".".join([keypart, key_name]))
-                if arr is None:
-                    # Key does not exist
-                    continue
-                for i in range(len(arr)):
-                    new_keys.append(".".join([keypart, (key_name + f"[{i}]")]))
-            if not new_keys:
-                # If at any step we run out of keys, this keypath must not exist anywhere.
-                #  we can safely redact nothing and return
-                return []
-            all_keys = new_keys
-        else:
-            if len(all_keys) == 0:
-                all_keys.append(key_segment)
-            else:
-                all_keys = list(map(lambda k: ".".join([k, key_segment]), all_keys))
-
-    # Invariant: he first two elements of any keypath will always be
-    #  of the form '{request|response}.{body|headers}'
-    #  however for standardization we need to transform that to a single key
-    #  '{request|response}{Body|Headers}'
-    metadata = []
-    for key in all_keys:
-        keysplit = key.split(".")
-        if len(keysplit) == 2:  # to handle top-level redactions like responseBody
-            actual_key = ".".join([(keysplit[0] + keysplit[1].capitalize())])
-        else:
-            actual_key = ".".join(
-                [(keysplit[0] + keysplit[1].capitalize())] + keysplit[2:]
-            )
-        entry = get(input, key)
-        (data_type, data_length) = describe_data(entry)
+    ordinals = [ordinal for ordinal in node.ordinals if ordinal < limit]
+    if ordinals:
+        # This value gets redacted, so keys below it only apply if configured earlier
+        limit = ordinals[0]
+    value = parent[key]
+    if node.children and isinstance(value, dict):
+        for child_key, child in node.children.items():
+            if child.min_ordinal < limit and child_key in value:
+                child_path = f"{key_path}.{child_key}"
+                _redact_node(value, child_key, child, child_path, limit, skeys)
+    if node.elements and node.elements.min_ordinal < limit and isinstance(value, list):
+        for i in range(len(value)):
+            _redact_node(value, i, node.elements, f"{key_path}[{i}]", limit, skeys)
+    for ordinal in ordinals:
+        (data_type, data_length) = describe_data(parent[key])
         # NB: The UI only supports `redact` for now, so the clients only support is as well
-        set_(input, key, None)
-        metadata.append(
-            {
-                "keyPath": actual_key,
-                "type": data_type,
-                "length": data_length,
-            }
+        parent[key] = None
+        skeys.append(
+            (
+                ordinal,
+                {
+                    "keyPath": key_path,
+                    "type": data_type,
+                    "length": data_length,
+                },
+            )
         )
 
-    return metadata
 
+def redact_plan(obj, plan):
+    """
+    obj: a request/response/metadata event
+    plan: a RedactionPlan compiled from an endpoint's sensitive keys
 
-def redact_one(obj, endpoint):
+    Walks `obj` once, following the plan's trie. To redact a key that is present
+    in one or many array objects, e.g. `responseBody.added[].payment_instruments[].number`,
+    every element of each array is visited.
+
+    This function redacts (removes) every sensitive value in-place on `obj`
+    and returns metadata about each extracted key, which Supergood uses for schema
+    anomaly detection. Metadata is ordered by sensitive key, as configured.
+    """
+    if plan.invalid_key_path is not None:
+        raise Exception(f"unknown keypath {plan.invalid_key_path}")
     skeys = []
-    for key in endpoint.sensitive_keys:
-        if key.key_path.startswith("response") and not obj.get("response"):
+    truncated = obj.get("metadata", {}).get("truncated", {})
+    for (part1, part2), node in plan.sections.items():
+        container = obj.get(part1)
+        if not isinstance(container, dict) or part2 not in container:
             continue
-        key_split = key.key_path.split(".")
-        top_level_array = key_split[0].endswith("[]")
-        if key_split[0].startswith("requestBody"):
-            keypart1 = "request"
-            keypart2 = "body"
-        elif key_split[0].startswith("requestHeaders"):
-            keypart1 = "request"
-            keypart2 = "headers"
-        elif key_split[0].startswith("responseBody"):
-            keypart1 = "response"
-            keypart2 = "body"
-        elif key_split[0].startswith("responseHeaders"):
-            keypart1 = "response"
-            keypart2 = "headers"
-        else:
-            raise Exception(f"unknown keypath {key.key_path}")
-
-        if top_level_array:
-            keypart2 += "[]"
-        keypath = ".".join([keypart1, keypart2])
-        if len(key_split) > 1:
-            keypath = ".".join([keypath] + key_split[1:])
-
-        if "[]" in keypath:
-            # Keys within an array require iterative redaction
-            redactions = deep_redact_(obj, keypath, key.action.lower())
-            skeys += redactions
-        else:
-            item, exists = get_with_exists(obj, keypath)
-            if not exists:
-                # Key not present, move on
-                continue
-            (data_type, data_length) = describe_data(item)
-            skeys.append(
-                {
-                    "keyPath": key.key_path,
-                    "type": data_type,
-                    "length": data_length,
-                }
-            )
-            # NB: the only action supported for now is `redact`
-            set_(obj, keypath, None)
-    return skeys
+        # keyPaths are standardized to start with '{request|response}{Body|Headers}'
+        key_path = part1 + part2.capitalize()
+        if key_path in truncated:
+            # A truncated body can't be parsed, so sensitive keys can't be found in it
+            #  redact the whole body instead
+            node = RedactionNode(ordinals=[node.min_ordinal])
+        _redact_node(container, part2, node, key_path, sys.maxsize, skeys)
+    # sort is stable, so values for the same key stay in document order
+    skeys.sort(key=lambda entry: entry[0])
+    return [entry for (_, entry) in skeys]
 
 
-def redact_values(input_array, remote_config, base_config):
+def redact_one(obj, endpoint):
+    plan = endpoint.redaction_plan
+    if plan is None:
+        # endpoint was not built by parse_remote_config_json
+        plan = compile_redaction_plan(endpoint.sensitive_keys)
+    return redact_plan(obj, plan)
+
+
+def redact_values(input_array, remote_config, base_config, match_cache=None):
     """
     input_array: a dictionary, mapping request id to `request, response, metadata` object
     remote_config: the SG remote config
+    match_cache: an optional MatchCache used when looking up endpoints
 
     data is redacted in-place
     redaction info is placed in the metadata
@@ -350,6 +271,7 @@ def redact_values(input_array, remote_config, base_config):
                 method=data["request"].get("method"),
                 request_body=data["request"]["body"],
                 request_headers=data["request"]["headers"],
+                cache=match_cache,
             )
         if endpoint:
             # Matched endpoint. Check ignore and then sensitive keys
@@ -366,6 +288,69 @@ def redact_values(input_array, remote_config, base_config):
     return remove_indices
 
 
+def truncate_body(body, limit):
+    """
+    Caps a raw request or response body at `limit` bytes, before it is decoded or parsed
+    Gzipped bodies are only decompressed up to the limit
+
+    returns a tuple of (body, truncation)
+    truncation is None if the body fits, otherwise the body is returned as
+    decoded text and truncation describes what was dropped:
+    size: total size of the body as captured (compressed size, for gzipped bodies)
+    retained: bytes (or characters, for text bodies) that were kept
+    """
+    if limit is None or body is None:
+        return body, None
+    if isinstance(body, str):
+        if len(body) <= limit:
+            return body, None
+        return body[:limit], {"size": len(body), "retained": limit}
+    if not isinstance(body, (bytes, bytearray, memoryview)):
+        # not a raw body (e.g. a file or generator being uploaded), leave it alone
+        return body, None
+    if body[:2] == GZIP_START_BYTES:
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        try:
+            retained = decompressor.decompress(body, limit)
+        except zlib.error:
+            retained = None
+        if retained is not None:
+            if decompressor.eof or not decompressor.unconsumed_tail:
+                return retained, None
+            truncation = {"size": len(body), "retained": len(retained), "gzip": True}
+            return retained.decode("utf-8", errors="ignore"), truncation
+    if len(body) <= limit:
+        return body, None
+    retained = bytes(body[:limit]).decode("utf-8", errors="ignore")
+    return retained, {"size": len(body), "retained": limit}
+
+
+def cap_raw_body(body, limit):
+    """
+    Slices a body that is kept raw (not decoded) to `limit` bytes, or characters
+    for text bodies. Returns (body, truncation) like truncate_body
+    """
+    if (
+        limit is None
+        or not isinstance(body, (str, bytes, bytearray, memoryview))
+        or len(body) <= limit
+    ):
+        return body, None
+    return body[:limit], {"size": len(body), "retained": limit}
+
+
+def combine_truncation(first, second):
+    """
+    Describes a body cut off by `first`, then cut down further by `second`
+    The size is always the one `first` saw, i.e. the body's full size
+    """
+    if not first:
+        return second
+    if not second:
+        return first
+    return {**first, **second, "size": first["size"]}
+
+
 def safe_parse_json(input: str):
     if not input:
         return ""
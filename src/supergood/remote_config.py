@@ -1,11 +1,19 @@
 import json
+import os
 import re
-from dataclasses import dataclass
-from typing import Dict, List, Tuple, Union
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Tuple, Union
 from urllib.parse import urlparse
 
 import tldextract
 
+from .sampling import normalize_sample_rate
+
 
 @dataclass
 class SensitiveKey:
@@ -19,6 +27,58 @@ class SensitiveKey:
     action: str
 
 
+@dataclass
+class RedactionPath:
+    """
+    A sensitive key path, tokenized when the config is parsed
+    key_path: the original key path, e.g. responseBody.items[].card
+    section: the (request|response, body|headers) pair the path starts in.
+      None if the key path does not start with a known section
+    root_array: whether the section itself is an array, e.g. responseBody[].id
+    segments: a (key, is_array) pair for each part of the path after the section
+    action: the action to take on values at this path
+    """
+
+    key_path: str
+    section: Optional[Tuple[str, str]]
+    root_array: bool
+    segments: List[Tuple[str, bool]]
+    action: str
+
+
+@dataclass
+class RedactionNode:
+    """
+    A location in a request or response where sensitive keys may be found
+    ordinals: config order of each sensitive key ending at this location
+    children: locations under this one, when its value is an object
+    elements: location of every element of this one, when its value is an array
+    min_ordinal: the lowest ordinal of any sensitive key at or below this location
+    """
+
+    ordinals: List[int] = field(default_factory=list)
+    children: Dict[str, "RedactionNode"] = field(default_factory=dict)
+    elements: Optional["RedactionNode"] = None
+    min_ordinal: int = sys.maxsize
+
+
+@dataclass
+class RedactionPlan:
+    """
+    All of an endpoint's sensitive keys merged into one trie of locations,
+    so every key can be applied in a single walk of a request/response
+    paths: the tokenized sensitive keys, in config order
+    sections: root location for each (request|response, body|headers) section
+    invalid_key_path: the first key path with an unknown section, if any
+    allowed_key_paths: key paths marked 'ALLOW', for redactByDefault mode
+    """
+
+    paths: List[RedactionPath]
+    sections: Dict[Tuple[str, str], RedactionNode]
+    invalid_key_path: Optional[str] = None
+    allowed_key_paths: FrozenSet[str] = frozenset()
+
+
 @dataclass
 class EndpointConfiguration:
     """
@@ -27,6 +87,10 @@ class EndpointConfiguration:
     location: Where to find the value to test the regex against
     action: 'Allow' (no-ops), 'Ignore' (does not cache)
     sensitive_keys: Keys to redact from the request and response
+    redaction_plan: sensitive_keys compiled into a RedactionPlan
+    request_body_byte_limit: overrides the client's requestBodyByteLimit, if set
+    response_body_byte_limit: overrides the client's responseBodyByteLimit, if set
+    sample_rate: fraction of events to keep, overrides the client's sampleRate if set
     """
 
     endpoint_id: str
@@ -35,6 +99,12 @@ class EndpointConfiguration:
     location: str
     action: str
     sensitive_keys: List[SensitiveKey]
+    redaction_plan: Optional[RedactionPlan] = field(
+        default=None, compare=False, repr=False
+    )
+    request_body_byte_limit: Optional[int] = None
+    response_body_byte_limit: Optional[int] = None
+    sample_rate: Optional[float] = None
 
 
 @dataclass
@@ -50,25 +120,47 @@ class VendorConfiguration:
     endpoints: Dict[str, EndpointConfiguration]
 
 
+# Maps the first segment of a key path to where it is found on an event
+KEY_PATH_SECTIONS = (
+    ("requestBody", ("request", "body")),
+    ("requestHeaders", ("request", "headers")),
+    ("responseBody", ("response", "body")),
+    ("responseHeaders", ("response", "headers")),
+)
+
+# Bumped whenever the on-disk snapshot format changes
+SNAPSHOT_VERSION = 1
+
+# Locations which test the request payload rather than the url
+PAYLOAD_LOCATIONS = ("requestBody", "requestHeaders")
+
+# Only uses provided TLD cache. Doesnt make call for updates
+#  constructing an extractor is expensive, so one instance is shared
+_extract = tldextract.TLDExtract(suffix_list_urls=())
+
+
+# Matches backreferences, which would point at the wrong group once combined
+
+
 def get_endpoint_test_val(
     location,
     url=None,
     request_body=None,
     request_headers=None,
+    url_extract=None,
 ):
     """
     Uses the location to find the correct value to check endpoint regex against
+    url_extract: the already extracted url, if available
     """
-    # Only uses provided TLD cache. Doesnt make call for updates
-    extract = tldextract.TLDExtract(suffix_list_urls=())
     if location == "path":
         return urlparse(url).path
     elif location == "url":
         return url
     elif location == "domain":
-        return extract(url).domain
+        return (url_extract or _extract(url)).domain
     elif location == "subdomain":
-        return extract(url).subdomain
+        return (url_extract or _extract(url)).subdomain
     elif location == "requestHeaders":
         return json.dumps(request_headers)
     elif location == "requestBody":
@@ -77,53 +169,338 @@ def get_endpoint_test_val(
         return ""
 
 
+class EndpointGroup(object):
+    """
+    The endpoints of one vendor sharing a method and location, in configured order
+    endpoints: list of (ordinal, EndpointConfiguration)
+    Grouping by location means the value each regex is tested against (e.g. a
+    serialized body) is computed once per group, not once per endpoint
+    """
+
+    def __init__(self, location, endpoints):
+        self.location = location
+        self.endpoints = endpoints
+
+    def first_match(self, test_val):
+        """
+        Returns (ordinal, EndpointConfiguration) of the first endpoint matching test_val
+        """
+        # a plain search per endpoint keeps each regex's own literal prefix scan,
+        #  which is faster than any pattern combining them that still honours order
+        for ordinal, endpoint in self.endpoints:
+            if endpoint.regex.search(test_val):
+                return (ordinal, endpoint)
+        return None
+
+
+class EndpointMatcher(object):
+    """
+    Compiled lookup structure over a remote config, built once per config
+    Vendors are indexed by domain, so resolving a vendor for a url costs one
+    dictionary lookup per label of the host rather than a scan of every vendor.
+    Each vendor's endpoints are grouped by method and then by location,
+    and each group is matched with a single combined regex
+    previous: the matcher of the last config. Groups of unchanged vendors are reused
+    """
+
+    def __init__(self, vendors, previous=None):
+        self._domains = {}
+        self._fallback = None
+        self._vendors = {}
+        self._groups = {}
+        for vendor in vendors:
+            if vendor.domain is None:
+                continue
+            domain = vendor.domain.lower()
+            if domain == "":
+                # an empty domain matches every host. Only used if nothing else matches
+                self._fallback = self._fallback or vendor
+            else:
+                # first vendor configured for a domain wins
+                self._domains.setdefault(domain, vendor)
+            self._vendors[vendor.vendor_id] = vendor
+            if previous and previous._vendors.get(vendor.vendor_id) is vendor:
+                self._groups[vendor.vendor_id] = previous._groups[vendor.vendor_id]
+            else:
+                self._groups[vendor.vendor_id] = self._group_endpoints(vendor)
+        # (vendor_id, method) pairs whose matching reads the request body or headers
+        self._payload_dependent = set(
+            (vendor_id, method)
+            for (vendor_id, by_method) in self._groups.items()
+            for (method, groups) in by_method.items()
+            if any(group.location in PAYLOAD_LOCATIONS for group in groups)
+        )
+
+    @staticmethod
+    def _group_endpoints(vendor):
+        """
+        Returns {method: [EndpointGroup, ...]}
+        ordinals preserve the configured endpoint order across locations
+        """
+        by_method = {}
+        for ordinal, endpoint in enumerate(vendor.endpoints.values()):
+            method = endpoint.method.lower() if endpoint.method else None
+            by_location = by_method.setdefault(method, {})
+            by_location.setdefault(endpoint.location, []).append((ordinal, endpoint))
+        return {
+            method: [
+                EndpointGroup(location, endpoints)
+                for (location, endpoints) in by_location.items()
+            ]
+            for (method, by_location) in by_method.items()
+        }
+
+    def depends_on_payload(self, vendor, method):
+        """
+        True when matching `method` calls against `vendor` tests the request body
+        or headers, meaning the result cannot be reused for another call to the same url
+        """
+        if not vendor:
+            return False
+        method = method.lower() if method else None
+        return (vendor.vendor_id, method) in self._payload_dependent
+
+    def get_vendor(self, url):
+        return self._get_vendor(_extract(url))
+
+    def _get_vendor(self, url_extract):
+        search = (url_extract.fqdn or url_extract.domain).lower()
+        # walk from the full host up through each parent domain
+        while search:
+            vendor = self._domains.get(search)
+            if vendor:
+                return vendor
+            _, _, search = search.partition(".")
+        return self._domains.get(url_extract.domain.lower(), self._fallback)
+
+    def match(
+        self,
+        url=None,
+        method=None,
+        request_body=None,
+        request_headers=None,
+    ) -> Tuple[Union[None, VendorConfiguration], Union[None, EndpointConfiguration]]:
+        url_extract = _extract(url)
+        vendor = self._get_vendor(url_extract)
+        if not vendor:
+            return (None, None)
+        groups = self._groups[vendor.vendor_id].get(
+            method.lower() if method else None, []
+        )
+        # Each group has a distinct location, so every test value
+        #  (including serialized bodies and headers) is computed at most once
+        best = None
+        for group in groups:
+            if best is not None and group.endpoints[0][0] > best[0]:
+                # every endpoint in this group comes after the current match
+                continue
+            test_val = get_endpoint_test_val(
+                location=group.location,
+                url=url,
+                request_body=request_body,
+                request_headers=request_headers,
+                url_extract=url_extract,
+            )
+            found = group.first_match(test_val)
+            if found is not None and (best is None or found[0] < best[0]):
+                best = found
+        return vendor, (best[1] if best else None)
+
+
+class RemoteConfig(dict):
+    """
+    Parsed remote config, mapping vendor id to VendorConfiguration
+    matcher: EndpointMatcher compiled from the vendors
+    previous: the last parsed RemoteConfig, whose unchanged vendors are reused
+    """
+
+    def __init__(self, vendors=None, previous=None):
+        super().__init__(vendors or {})
+        self.matcher = EndpointMatcher(
+            self.values(), previous=getattr(previous, "matcher", None)
+        )
+
+
+class MatchCache(object):
+    """
+    Bounded LRU cache of matcher results, keyed on (method, url)
+    Negative (no vendor / no endpoint) results are cached as well.
+    Each entry remembers the matcher that produced it, so results from a
+    previous remote config are never returned after a new one is installed.
+    Results that depend on the request body or headers are never cached
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, matcher, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not matcher:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, matcher, key, result):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (matcher, result)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def bypass(self):
+        """
+        Re-counts the last miss as a bypass: the lookup turned out to depend on
+        the request payload, so it could never have been cached
+        """
+        with self._lock:
+            self.misses -= 1
+            self.bypasses += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "size": len(self._entries),
+        }
+
+
 def get_vendor_endpoint_from_config(
     remote_config,
     url=None,
     method=None,
     request_body=None,
     request_headers=None,
+    cache=None,
 ) -> Tuple[Union[None, VendorConfiguration], Union[None, EndpointConfiguration]]:
     """
     Using the url, request_body, and request_headers
     matches to the vendors/endpoints in remote_config
     and returns a tuple of (VendorConfiguration, EndpointConfiguration)
     if it finds a match, otherwise (None, None)
+    If a MatchCache is provided, results are read from and stored in it
     """
-    extract = tldextract.TLDExtract(suffix_list_urls=())
-    url_extract = extract(url)
-    search = url_extract.fqdn or url_extract.domain
-    vendor_config = next(
-        (vcfg for vcfg in remote_config.values() if vcfg.domain in search), None
+    matcher = getattr(remote_config, "matcher", None)
+    if matcher is None:
+        # plain dictionaries don't carry a compiled matcher, build one
+        matcher = EndpointMatcher(remote_config.values())
+    if cache is not None:
+        key = (method, url)
+        result = cache.get(matcher, key)
+        if result is not None:
+            return result
+    result = matcher.match(
+        url=url,
+        method=method,
+        request_body=request_body,
+        request_headers=request_headers,
     )
-    compare_method = method.lower() if method else None
+    if cache is not None:
+        if matcher.depends_on_payload(result[0], method):
+            cache.bypass()
+        else:
+            cache.put(matcher, key, result)
+    return result
 
-    def match(endpoint):
-        test_method = endpoint.method.lower() if endpoint.method else None
-        return test_method == compare_method and endpoint.regex.search(
-            get_endpoint_test_val(
-                location=endpoint.location,
-                url=url,
-                request_body=request_body,
-                request_headers=request_headers,
-            )
-        )
 
-    if vendor_config:
-        return vendor_config, next(
-            (ep for ep in vendor_config.endpoints.values() if match(ep)),
-            None,
-        )
-    else:
-        return (None, None)
+def compile_redaction_path(sensitive_key: SensitiveKey) -> RedactionPath:
+    """
+    Tokenizes a key path of the form `responseBody.key1[].key2`
+    """
+    key_split = sensitive_key.key_path.split(".")
+    section = next(
+        (loc for (name, loc) in KEY_PATH_SECTIONS if key_split[0].startswith(name)),
+        None,
+    )
+    segments = [
+        (segment[:-2], True) if segment.endswith("[]") else (segment, False)
+        for segment in key_split[1:]
+    ]
+    return RedactionPath(
+        key_path=sensitive_key.key_path,
+        section=section,
+        root_array=key_split[0].endswith("[]"),
+        segments=segments,
+        action=sensitive_key.action,
+    )
+
+
+def compile_redaction_plan(sensitive_keys: List[SensitiveKey]) -> RedactionPlan:
+    """
+    Merges the tokenized sensitive keys into a trie of RedactionNodes
+    """
+    paths = [compile_redaction_path(key) for key in sensitive_keys]
+    sections = {}
+    invalid_key_path = None
+    for ordinal, path in enumerate(paths):
+        if path.section is None:
+            invalid_key_path = invalid_key_path or path.key_path
+            continue
+        node = sections.setdefault(path.section, RedactionNode())
+        if path.root_array:
+            node.elements = node.elements or RedactionNode()
+            node = node.elements
+        for segment, is_array in path.segments:
+            node = node.children.setdefault(segment, RedactionNode())
+            if is_array:
+                node.elements = node.elements or RedactionNode()
+                node = node.elements
+        node.ordinals.append(ordinal)
+    for node in sections.values():
+        _order_redaction_node(node)
+    sections = dict(sorted(sections.items(), key=lambda item: item[1].min_ordinal))
+    allowed_key_paths = frozenset(
+        key.key_path for key in sensitive_keys if key.action == "ALLOW"
+    )
+    return RedactionPlan(paths, sections, invalid_key_path, allowed_key_paths)
+
+
+def _order_redaction_node(node):
+    """
+    Sets min_ordinal on node and its descendants, and orders children by it
+    """
+    min_ordinal = node.ordinals[0] if node.ordinals else sys.maxsize
+    for child in node.children.values():
+        min_ordinal = min(min_ordinal, _order_redaction_node(child))
+    node.children = dict(
+        sorted(node.children.items(), key=lambda item: item[1].min_ordinal)
+    )
+    if node.elements:
+        min_ordinal = min(min_ordinal, _order_redaction_node(node.elements))
+    node.min_ordinal = min_ordinal
+    return min_ordinal
 
 
 def parse_remote_config_json(
     config: List[Dict],
-) -> Dict[str, VendorConfiguration]:
+    previous: Union[None, RemoteConfig] = None,
+) -> RemoteConfig:
+    """
+    Parses the remote config returned by the API
+    previous: the currently installed config. Endpoints and vendors which have not
+      changed are reused from it, along with their compiled regexes and redaction
+      plans, and if nothing changed at all `previous` itself is returned
+    """
+    previous_vendors = previous or {}
     remote_config = {}
     for entry in config:
         vendor_id = entry.get("id")
+        previous_vendor = previous_vendors.get(vendor_id)
+        previous_endpoints = previous_vendor.endpoints if previous_vendor else {}
         endpoints = []
         for endpoint in entry.get("endpoints"):
             matchingRegex = endpoint.get("matchingRegex")
@@ -132,6 +509,7 @@ def parse_remote_config_json(
                 # Assume 'Allow' and no sensitive keys when conf is empty
                 action = "Allow"
                 sensitive_keys = []
+                endpointConfiguration = {}
             else:
                 action = endpointConfiguration.get("action")
                 sensitive_keys = list(
@@ -141,46 +519,123 @@ def parse_remote_config_json(
                     )
                 )
 
-            regex = re.compile(matchingRegex.get("regex"))
-            endpoints.append(
-                EndpointConfiguration(
-                    endpoint.get("id"),
-                    endpoint.get("method"),
-                    regex,
-                    matchingRegex.get("location"),
-                    action,
-                    sensitive_keys,
-                )
+            previous_endpoint = previous_endpoints.get(endpoint.get("id"))
+            if previous_endpoint and (
+                previous_endpoint.regex.pattern == matchingRegex.get("regex")
+            ):
+                regex = previous_endpoint.regex
+            else:
+                regex = re.compile(matchingRegex.get("regex"))
+            if previous_endpoint and previous_endpoint.sensitive_keys == sensitive_keys:
+                redaction_plan = previous_endpoint.redaction_plan
+            else:
+                redaction_plan = compile_redaction_plan(sensitive_keys)
+            endpoint_config = EndpointConfiguration(
+                endpoint.get("id"),
+                endpoint.get("method"),
+                regex,
+                matchingRegex.get("location"),
+                action,
+                sensitive_keys,
+                redaction_plan,
+                request_body_byte_limit=endpointConfiguration.get(
+                    "requestBodyByteLimit"
+                ),
+                response_body_byte_limit=endpointConfiguration.get(
+                    "responseBodyByteLimit"
+                ),
+                sample_rate=normalize_sample_rate(
+                    endpointConfiguration.get("sampleRate")
+                ),
             )
+            if endpoint_config == previous_endpoint:
+                endpoint_config = previous_endpoint
+            endpoints.append(endpoint_config)
         vendor_config = VendorConfiguration(
             vendor_id=vendor_id,
             domain=entry.get("domain"),
             endpoints={ep.endpoint_id: ep for ep in endpoints},
         )
+        if _unchanged_vendor(vendor_config, previous_vendor):
+            vendor_config = previous_vendor
         remote_config[vendor_id] = vendor_config
 
-    return remote_config
+    if previous is not None and list(remote_config.keys()) == list(previous.keys()):
+        if all(remote_config[key] is previous[key] for key in previous):
+            return previous
+    return RemoteConfig(remote_config, previous=previous)
+
+
+def _unchanged_vendor(vendor_config, previous_vendor):
+    if previous_vendor is None or vendor_config.domain != previous_vendor.domain:
+        return False
+    endpoints = list(vendor_config.endpoints.items())
+    previous_endpoints = list(previous_vendor.endpoints.items())
+    return len(endpoints) == len(previous_endpoints) and all(
+        id == previous_id and endpoint is previous_endpoint
+        for ((id, endpoint), (previous_id, previous_endpoint)) in zip(
+            endpoints, previous_endpoints
+        )
+    )
 
 
-def get_allowed_keys(remote_config, vendor_id, endpoint_id):
-    # log.debug("getting allowed keys")
+def get_allowed_keys(remote_config, vendor_id, endpoint_id) -> FrozenSet[str]:
+    """
+    Returns the set of key paths allowed by the endpoint in redactByDefault mode
+    """
     vendor_config = remote_config.get(vendor_id, None)
-    if not vendor_config:
-        # log.debug("got null vendor config")
-        return []
-    endpoints = vendor_config.endpoints
-    if not endpoints:
-        # log.debug("got null endpoints")
-        return []
-    endpoint = endpoints.get(endpoint_id, None)
-    if not endpoint:
-        # log.debug("got null endpoint")
-        return []
-    sensitive_keys = endpoint.sensitive_keys
-    if not sensitive_keys:
-        # log.debug("no sensitive keys")
-        return []
-    filtered = list(filter(lambda x: x.action == "ALLOW", sensitive_keys))
-    mapped = list(map(lambda x: x.key_path, filtered))
-    # log.debug(mapped)
-    return mapped
+    if not vendor_config or not vendor_config.endpoints:
+        return frozenset()
+    endpoint = vendor_config.endpoints.get(endpoint_id, None)
+    if not endpoint or not endpoint.sensitive_keys:
+        return frozenset()
+    if endpoint.redaction_plan is None:
+        # endpoint was not built by parse_remote_config_json
+        return compile_redaction_plan(endpoint.sensitive_keys).allowed_key_paths
+    return endpoint.redaction_plan.allowed_key_paths
+
+
+def save_remote_config_snapshot(path, config, etag=None):
+    """
+    Atomically writes the raw remote config (as returned by the API) to `path`
+    so the next process to start can load it without waiting on the network
+    """
+    snapshot = {"version": SNAPSHOT_VERSION, "etag": etag, "config": config}
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def touch_remote_config_snapshot(path):
+    """
+    Marks the snapshot at `path` as still current, e.g. after the API confirms
+    the config hasn't changed
+    """
+    if os.path.exists(path):
+        os.utime(path)
+
+
+def load_remote_config_snapshot(path, max_age=None):
+    """
+    Reads a snapshot written by `save_remote_config_snapshot`
+    max_age: seconds since the snapshot was last written or touched
+    returns a tuple of (raw config, etag), or None if there is no usable snapshot
+    """
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+    if max_age is not None and age > max_age:
+        return None
+    with open(path) as f:
+        snapshot = json.load(f)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return snapshot["config"], snapshot.get("etag")
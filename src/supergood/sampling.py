@@ -0,0 +1,76 @@
+import random
+from dataclasses import dataclass
+from typing import FrozenSet, Optional
+
+
+def normalize_sample_rate(rate):
+    """
+    Clamps a configured sample rate to [0, 1]
+    None (not configured) is passed through
+    """
+    if rate is None:
+        return None
+    return min(max(float(rate), 0.0), 1.0)
+
+
+def is_sampled(rate):
+    """
+    rate: fraction of events to keep, in [0, 1]
+    returns True if this event should be kept
+    """
+    if rate >= 1:
+        return True
+    return rate > 0 and random.random() < rate
+
+
+@dataclass
+class TailSampler:
+    """
+    Decides which completed events to keep, once their response is known
+    Events matching any rule are always kept, the rest are sampled at sample_rate
+    status_classes: leading digits of statuses to keep, e.g. 5 for 5xx
+    latency_threshold: keep events slower than this, in milliseconds
+    endpoint_ids: keep events matched to these remote config endpoints
+    """
+
+    sample_rate: float
+    status_classes: FrozenSet[int] = frozenset()
+    latency_threshold: Optional[float] = None
+    endpoint_ids: FrozenSet[str] = frozenset()
+
+    @classmethod
+    def from_config(cls, base_config):
+        """
+        Returns None when tail sampling is off, i.e. every event is kept
+        """
+        sample_rate = normalize_sample_rate(base_config["tailSampleRate"])
+        if sample_rate is None or sample_rate >= 1:
+            return None
+        return cls(
+            sample_rate,
+            status_classes=frozenset(
+                int(str(status_class)[0])
+                for status_class in base_config["tailSampleStatusClasses"]
+            ),
+            latency_threshold=base_config["tailSampleLatencyThreshold"],
+            endpoint_ids=frozenset(base_config["tailSampleEndpointIds"]),
+        )
+
+    def keep(self, status, elapsed, endpoint_id=None):
+        """
+        status: response status code
+        elapsed: time from request to response, in milliseconds
+        returns (keep, sampled): sampled is True when kept by sample_rate
+          rather than by a rule
+        """
+        try:
+            status_class = int(status) // 100
+        except (TypeError, ValueError):
+            status_class = None
+        if (
+            status_class in self.status_classes
+            or (self.latency_threshold is not None and elapsed > self.latency_threshold)
+            or (endpoint_id is not None and endpoint_id in self.endpoint_ids)
+        ):
+            return True, False
+        return is_sampled(self.sample_rate), True
@@ -1,43 +1,176 @@
-from uuid import uuid4
+import time
+import weakref
 
 import aiohttp
+from aiohttp.client_proto import ResponseHandler
+from aiohttp.streams import StreamReader
 
-from ..constants import REQUEST_ID_KEY
+from .helpers import StreamAccumulator, new_request_id, original_of, wrapping
 
 
-def patch(cache_request, cache_response):
-    _original_request = aiohttp.client.ClientSession._request
-    _original_read = aiohttp.client_reqrep.ClientResponse.read
+class ResponseTap:
+    """
+    Collects an aiohttp response body as the connection feeds it into response.content
+    """
 
-    async def _wrap_request(clientSession, method, url, *args, **kwargs):
-        request_id = str(uuid4())
-        body = kwargs.get("json", None) or kwargs.get("data", None)
-        headers = kwargs.get("headers", None)
+    # holds what it needs of the response, not the response, so a dropped
+    #  response isn't kept alive by its tap
+    __slots__ = (
+        "request_id",
+        "headers",
+        "status",
+        "reason",
+        "accumulator",
+        "first_byte_ns",
+        "reused",
+    )
 
-        cache_request(request_id, url, method, body, headers)
+    def __init__(self, request_id, response, stream_limit, first_byte_ns, reused):
+        self.request_id = request_id
+        self.headers = response.headers
+        self.status = response.status
+        self.reason = response.reason
+        self.accumulator = StreamAccumulator(limit=stream_limit)
+        self.first_byte_ns = first_byte_ns
+        self.reused = reused
 
-        response = await _original_request(clientSession, method, url, *args, **kwargs)
-        setattr(response, REQUEST_ID_KEY, request_id)
 
-        return response
+def patch(cache_request, cache_response, stream_limit=None):
+    """
+    stream_limit: most bytes of a request or response body to hold on to
 
-    async def _wrap_read(clientResponse):
-        request_id = getattr(clientResponse, REQUEST_ID_KEY, None)
-        response_body = await _original_read(clientResponse)
-        if request_id is None:
-            return response_body
-        response_headers = clientResponse.headers
-        response_status = clientResponse.status
-        response_status_text = clientResponse.reason
+    Captures through a TraceConfig added to every ClientSession, so nothing extra
+    is awaited on the event loop. Response bodies are tapped as they are fed to
+    response.content, and captured once at EOF, when the response is released or
+    closed, when its connection is lost or closed, or when it is garbage collected
+    """
+    _original_session_init = original_of(aiohttp.ClientSession.__init__)
+    _original_feed_data = original_of(StreamReader.feed_data)
+    _original_release = original_of(aiohttp.ClientResponse.release)
+    _original_close = original_of(aiohttp.ClientResponse.close)
+    _original_set_exception = original_of(StreamReader.set_exception)
+    _original_handler_close = original_of(ResponseHandler.close)
+    _original_handler_abort = original_of(ResponseHandler.abort)
+    # id(response.content) -> ResponseTap, for responses whose body is still
+    #  arriving. A StreamReader can't be weakly referenced, and holding one holds
+    #  its response, so entries are keyed by id and dropped with the response
+    _taps = {}
 
-        cache_response(
+    async def _on_request_start(session, context, params):
+        context.supergood_requested_at = time.perf_counter_ns()
+        context.supergood_body = StreamAccumulator(limit=stream_limit)
+        context.supergood_reused = None
+
+    async def _on_request_chunk_sent(session, context, params):
+        body = getattr(context, "supergood_body", None)
+        if body is not None:
+            body.feed(params.chunk)
+
+    async def _on_connection_reuseconn(session, context, params):
+        context.supergood_reused = True
+
+    async def _on_connection_create_end(session, context, params):
+        context.supergood_reused = False
+
+    async def _on_request_end(session, context, params):
+        body = getattr(context, "supergood_body", None)
+        if body is None:
+            return
+        # the response headers are in, the body may still be arriving
+        first_byte_ns = time.perf_counter_ns()
+        request_id = new_request_id()
+        cache_request(
             request_id,
-            response_body,
-            response_headers,
-            response_status,
-            response_status_text,
+            str(params.url),
+            params.method,
+            body.finish(),
+            params.headers,
+            requested_at=context.supergood_requested_at,
+        )
+        response = params.response
+        stream = response.content
+        tap = ResponseTap(
+            request_id, response, stream_limit, first_byte_ns, context.supergood_reused
+        )
+        # anything the connection fed in before now hasn't been read yet
+        for chunk in getattr(stream, "_buffer", ()):
+            tap.accumulator.feed(chunk)
+        key = id(stream)
+        _taps[key] = tap
+        stream.on_eof(lambda: _capture(key))
+        # dropped without being read to EOF, released or closed
+        weakref.finalize(response, _capture, key).atexit = False
+
+    def _capture(key):
+        tap = _taps.pop(key, None)
+        if tap is None:
+            return
+        cache_response(
+            request_id=tap.request_id,
+            response_body=tap.accumulator.finish(),
+            response_headers=tap.headers,
+            response_status=tap.status,
+            response_status_text=tap.reason,
+            first_byte_ns=tap.first_byte_ns,
+            response_truncation=tap.accumulator.truncation,
+            connection_reused=tap.reused,
         )
-        return response_body
 
-    aiohttp.client.ClientSession._request = _wrap_request
-    aiohttp.client_reqrep.ClientResponse.read = _wrap_read
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_chunk_sent.append(_on_request_chunk_sent)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_request_end.append(_on_request_end)
+
+    def _wrap_session_init(session, *args, **kwargs):
+        kwargs["trace_configs"] = [*(kwargs.get("trace_configs") or []), trace_config]
+        _original_session_init(session, *args, **kwargs)
+
+    def _wrap_feed_data(stream, data, *args, **kwargs):
+        if _taps:
+            tap = _taps.get(id(stream))
+            if tap is not None:
+                tap.accumulator.feed(data)
+        return _original_feed_data(stream, data, *args, **kwargs)
+
+    def _wrap_release(response):
+        # released before EOF, capture what arrived so far
+        if _taps and getattr(response, "content", None) is not None:
+            _capture(id(response.content))
+        return _original_release(response)
+
+    def _wrap_close(response):
+        if _taps and getattr(response, "content", None) is not None:
+            _capture(id(response.content))
+        return _original_close(response)
+
+    def _wrap_set_exception(stream, *args, **kwargs):
+        # e.g. the connection was lost before EOF, capture what arrived so far.
+        #  This also drops the EOF callback
+        if _taps:
+            _capture(id(stream))
+        return _original_set_exception(stream, *args, **kwargs)
+
+    def _wrap_handler_close(handler):
+        # e.g. the session was closed, which detaches the unfinished body
+        #  without an EOF or an exception
+        if _taps and handler._payload is not None:
+            _capture(id(handler._payload))
+        return _original_handler_close(handler)
+
+    def _wrap_handler_abort(handler):
+        if _taps and handler._payload is not None:
+            _capture(id(handler._payload))
+        return _original_handler_abort(handler)
+
+    # a second patch replaces these wrappers, rather than wrapping them again
+    aiohttp.ClientSession.__init__ = wrapping(
+        _wrap_session_init, _original_session_init
+    )
+    StreamReader.feed_data = wrapping(_wrap_feed_data, _original_feed_data)
+    aiohttp.ClientResponse.release = wrapping(_wrap_release, _original_release)
+    aiohttp.ClientResponse.close = wrapping(_wrap_close, _original_close)
+    StreamReader.set_exception = wrapping(_wrap_set_exception, _original_set_exception)
+    ResponseHandler.close = wrapping(_wrap_handler_close, _original_handler_close)
+    ResponseHandler.abort = wrapping(_wrap_handler_abort, _original_handler_abort)
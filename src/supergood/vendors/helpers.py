@@ -1,6 +1,31 @@
 import dataclasses
+import itertools
 import json
+import os
+import re
+from contextvars import ContextVar
 from typing import List, Optional
+from uuid import UUID
+
+# Set while a higher level patch (e.g. requests) is capturing a call, so the
+#  http.client and urllib3 patches below it don't capture it again
+CAPTURED_ABOVE = ContextVar("supergood_captured_above", default=False)
+
+
+def original_of(function):
+    """
+    The unwrapped original of a function patched below, so patching again (e.g. on
+    a second Client.initialize) replaces the earlier wrapper instead of stacking on it
+    """
+    return getattr(function, "_supergood_original", function)
+
+
+def wrapping(wrapper, original):
+    """
+    Marks `wrapper` as a patch of `original`, for original_of
+    """
+    wrapper._supergood_original = original
+    return wrapper
 
 
 class DataclassesJSONEncoder(json.JSONEncoder):
@@ -20,3 +45,201 @@ class ServerSentEvent:
     data: List[str]
     id: Optional[str]
     retry: Optional[int]
+
+
+def parse_sse(chunk: str):
+    """
+    Parses a single server sent event, `chunk` ends with the blank line dispatching it
+    Returns None for comments and chunks that never dispatch
+    """
+    data = []
+    event = None
+    id = None
+    retry = None
+
+    for line in chunk.splitlines():
+        if not line:
+            # empty newline = dispatch
+            sse = ServerSentEvent(event, data, id, retry)
+            return sse
+        if line.startswith(":"):
+            return None
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "event":
+            event = value
+        elif field == "data":
+            # parse the value as json if it's serializable. otherwise use a string
+            try:
+                serialized = json.loads(value)
+            except:
+                serialized = value
+            data.append(serialized)
+        elif field == "id":
+            if "\0" not in value:
+                id = value
+        elif field == "retry":
+            try:
+                retry = int(value)
+            except (TypeError, ValueError):
+                # what do?
+                pass
+    # if we got to the end but didn't get a dispatch instruction, sse was invalid
+    return None
+
+
+# non text/* media types whose bodies are text
+_TEXT_MEDIA_TYPES = frozenset(
+    [
+        "application/x-www-form-urlencoded",
+        "application/graphql",
+        "application/javascript",
+    ]
+)
+
+
+def is_text_content(content_type):
+    """
+    Whether a body of this content type is worth capturing as text
+    A missing content type is assumed to be text
+    """
+    if not content_type:
+        return True
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return (
+        media_type.startswith("text/")
+        or media_type.endswith(("/json", "+json", "/xml", "+xml"))
+        or media_type in _TEXT_MEDIA_TYPES
+    )
+
+
+# a blank line, in any of the line endings SSE allows, dispatches an event
+_SSE_DISPATCH = re.compile(rb"\r\n\r\n|\n\n|\r\r")
+
+
+class StreamAccumulator:
+    """
+    Collects a streamed response body in linear time and bounded memory
+    limit: most bytes of body to retain, None for no limit. Anything after is dropped
+    sse: parse the stream as server sent events as it arrives. The body is then a
+      JSON list of the parsed events rather than the raw stream
+    """
+
+    def __init__(self, limit=None, sse=False):
+        self.limit = limit
+        self.sse = sse
+        self.size = 0  # bytes fed, including any that were dropped
+        self.truncated = False
+        self._body = bytearray()
+        # sse only: the event currently being received, and how much of it was
+        #  already searched for a dispatching blank line
+        self._pending = bytearray()
+        self._scanned = 0
+
+    def feed(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        self.size += len(chunk)
+        if not self.sse:
+            self._retain(chunk)
+            return
+        if self.truncated:
+            # no room for more events, don't bother parsing them
+            self._pending = bytearray()
+            return
+        pending = self._pending
+        pending += chunk
+        # a blank line is at most 4 bytes, so it may straddle the previous chunk
+        search_from = max(self._scanned - 3, 0)
+        consumed = 0
+        while match := _SSE_DISPATCH.search(pending, search_from):
+            self._add_event(bytes(pending[consumed : match.end()]))
+            consumed = search_from = match.end()
+        if consumed:
+            del pending[:consumed]
+        if self.limit is not None and len(pending) > self.limit:
+            # an event this large can't be kept, e.g. this isn't an SSE stream
+            #  at all. Stop buffering and parsing rather than hold all of it
+            self.truncated = True
+            self._pending = bytearray()
+            self._scanned = 0
+            return
+        self._scanned = len(pending)
+
+    def _retain(self, data):
+        if self.truncated:
+            return
+        if self.limit is not None and len(self._body) + len(data) > self.limit:
+            self.truncated = True
+            if not self.sse:
+                # raw bodies keep whatever fits, a partial event is useless
+                self._body += data[: self.limit - len(self._body)]
+            return
+        self._body += data
+
+    def _add_event(self, raw):
+        decoded = raw.decode("utf-8", errors="replace")
+        try:
+            sse = parse_sse(decoded)
+            if sse is None:
+                return
+            entry = sse
+        except Exception:
+            # failing SSE parsing, just keep it as a string
+            entry = decoded
+        serialized = json.dumps(entry, cls=DataclassesJSONEncoder).encode("utf-8")
+        self._retain(b"," + serialized if self._body else serialized)
+
+    def finish(self):
+        """
+        Returns the accumulated body: bytes, or for SSE streams a JSON string
+        """
+        if not self.sse:
+            return bytes(self._body)
+        if self._pending and not self.truncated:
+            # must have been an invalid chunk, keep it anyway
+            leftover = self._pending.decode("utf-8", errors="replace")
+            serialized = json.dumps(leftover).encode("utf-8")
+            self._retain(b"," + serialized if self._body else serialized)
+            self._pending = bytearray()
+        return "[" + self._body.decode("utf-8") + "]"
+
+    @property
+    def truncation(self):
+        """
+        None if nothing was dropped, otherwise the size of the stream and of the body kept
+        """
+        if not self.truncated:
+            return None
+        return {"size": self.size, "retained": len(self._body)}
+
+
+def _reset_request_ids():
+    global _request_id_prefix, _request_id_counter
+    # random high 64 bits keep ids unique across processes, the counter within one
+    _request_id_prefix = int.from_bytes(os.urandom(8), "big") << 64
+    _request_id_counter = itertools.count()
+
+
+_reset_request_ids()
+if hasattr(os, "register_at_fork"):
+    # a forked child would otherwise hand out the same ids as its parent
+    os.register_at_fork(after_in_child=_reset_request_ids)
+
+
+def new_request_id() -> int:
+    """
+    Returns an id for correlating a captured request with its response
+    Much cheaper than uuid4, next() on itertools.count is atomic under the GIL
+    """
+    return _request_id_prefix | next(_request_id_counter)
+
+
+def format_request_id(request_id) -> str:
+    """
+    Renders an id from new_request_id as a UUID string, other ids are passed through
+    """
+    if isinstance(request_id, int):
+        return str(UUID(int=request_id))
+    return request_id
@@ -1,42 +1,123 @@
 import http.client
-from uuid import uuid4
+import time
 
-from ..constants import REQUEST_ID_KEY
+from ..constants import FIRST_BYTE_KEY, REQUEST_ID_KEY, RESPONSE_CAPTURE_KEY
+from .helpers import (
+    CAPTURED_ABOVE,
+    StreamAccumulator,
+    new_request_id,
+    original_of,
+    wrapping,
+)
 
 HTTPS_PORT = http.client.HTTPS_PORT
 
 
-def patch(cache_request, cache_response):
-    _original_read = http.client.HTTPResponse.read
-    _original_getresponse = http.client.HTTPConnection.getresponse
-    _original_request = http.client.HTTPConnection.request
+class ResponseCapture:
+    """
+    Body of an http.client response, collected across reads until EOF or close
+    reading: a wrapped read is in progress, so nested reads aren't counted twice
+    eof: the connection was closed during that read, capture once it returns
+    """
+
+    __slots__ = ("request_id", "accumulator", "reading", "eof")
+
+    def __init__(self, request_id, stream_limit):
+        self.request_id = request_id
+        self.accumulator = StreamAccumulator(limit=stream_limit)
+        self.reading = False
+        self.eof = False
+
+
+def patch(cache_request, cache_response, stream_limit=None):
+    """
+    stream_limit: most bytes of a response body to hold on to
+    """
+    _original_read = original_of(http.client.HTTPResponse.read)
+    _original_read1 = original_of(http.client.HTTPResponse.read1)
+    _original_readinto = original_of(http.client.HTTPResponse.readinto)
+    _original_readline = original_of(http.client.HTTPResponse.readline)
+    _original_close_conn = http.client.HTTPResponse._close_conn
+    _original_getresponse = original_of(http.client.HTTPConnection.getresponse)
+    _original_request = original_of(http.client.HTTPConnection.request)
     _original_getheaders = http.client.HTTPResponse.getheaders
 
-    def _wrap_read(httpResponse, amt=None):
-        response_object = httpResponse
-        response_body = _original_read(httpResponse, amt)
-        request_id = getattr(response_object, REQUEST_ID_KEY, None)
-        if request_id is None:
-            return response_body
-        response_headers = _original_getheaders(httpResponse)
-        response_status = response_object.status
-        response_status_text = response_object.reason
+    def _capture(httpResponse, capture):
+        # capture at most once per response
+        setattr(httpResponse, RESPONSE_CAPTURE_KEY, None)
+        accumulator = capture.accumulator
         cache_response(
-            request_id=request_id,
-            response_body=response_body,
-            response_headers=response_headers,
-            response_status=response_status,
-            response_status_text=response_status_text,
+            request_id=capture.request_id,
+            response_body=accumulator.finish(),
+            response_headers=_original_getheaders(httpResponse),
+            response_status=httpResponse.status,
+            response_status_text=httpResponse.reason,
+            first_byte_ns=getattr(httpResponse, FIRST_BYTE_KEY, None),
+            response_truncation=accumulator.truncation,
         )
-        return response_body
+
+    def _wrap_reader(original, to_bytes):
+        """
+        Wraps one of HTTPResponse's read methods so everything it returns is captured
+        to_bytes: gets the bytes read from (args, kwargs, result)
+        """
+
+        def _wrap(httpResponse, *args, **kwargs):
+            capture = getattr(httpResponse, RESPONSE_CAPTURE_KEY)
+            if capture is None or capture.reading:
+                return original(httpResponse, *args, **kwargs)
+            capture.reading = True
+            try:
+                result = original(httpResponse, *args, **kwargs)
+                capture.accumulator.feed(to_bytes(args, kwargs, result))
+                return result
+            finally:
+                capture.reading = False
+                if capture.eof:
+                    _capture(httpResponse, capture)
+
+        return _wrap
+
+    def _read_bytes(args, kwargs, data):
+        return data
+
+    def _readinto_bytes(args, kwargs, n):
+        # a view over the caller's buffer, copied once into the accumulator
+        buffer = args[0] if args else kwargs["b"]
+        return memoryview(buffer)[:n]
+
+    _wrapped_readline = _wrap_reader(_original_readline, _read_bytes)
+
+    def _wrap_readline(httpResponse, *args, **kwargs):
+        if httpResponse.chunked:
+            # falls back to IOBase.readline, which goes through read()
+            return _original_readline(httpResponse, *args, **kwargs)
+        return _wrapped_readline(httpResponse, *args, **kwargs)
+
+    def _wrap_close_conn(httpResponse):
+        # called once the body has been read entirely, or on close
+        _original_close_conn(httpResponse)
+        capture = getattr(httpResponse, RESPONSE_CAPTURE_KEY)
+        if capture is None:
+            return
+        if capture.reading:
+            # the read in progress still has to return its data
+            capture.eof = True
+        else:
+            _capture(httpResponse, capture)
 
     def _wrap_getresponse(httpConnection):
         response_object = _original_getresponse(httpConnection)
-        try:
-            request_id = getattr(httpConnection, REQUEST_ID_KEY)
+        # the status line and headers have been read by now
+        setattr(response_object, FIRST_BYTE_KEY, time.perf_counter_ns())
+        request_id = getattr(httpConnection, REQUEST_ID_KEY, None)
+        if request_id is not None:
             setattr(response_object, REQUEST_ID_KEY, request_id)
-        except AttributeError:
-            pass
+            setattr(
+                response_object,
+                RESPONSE_CAPTURE_KEY,
+                ResponseCapture(request_id, stream_limit),
+            )
         return response_object
 
     def _wrap_request(
@@ -48,7 +129,19 @@ def patch(cache_request, cache_response):
         encode_chunked=False,
         **kwargs,
     ):
-        request_id = str(uuid4())
+        if CAPTURED_ABOVE.get():
+            # don't let the connection's previous request id leak onto this response
+            setattr(httpConnection, REQUEST_ID_KEY, None)
+            return _original_request(
+                httpConnection,
+                method,
+                path,
+                body=body,
+                headers=headers,
+                encode_chunked=encode_chunked,
+                **kwargs,
+            )
+        request_id = new_request_id()
         setattr(httpConnection, REQUEST_ID_KEY, request_id)
         scheme = "https" if httpConnection.port == HTTPS_PORT else "http"
         url = f"{scheme}://{httpConnection.host}{path}"
@@ -63,6 +156,23 @@ def patch(cache_request, cache_response):
             **kwargs,
         )
 
-    http.client.HTTPResponse.read = _wrap_read
-    http.client.HTTPConnection.getresponse = _wrap_getresponse
-    http.client.HTTPConnection.request = _wrap_request
+    # lets reads skip a failed instance attribute lookup on uncaptured responses
+    setattr(http.client.HTTPResponse, RESPONSE_CAPTURE_KEY, None)
+    # a second patch replaces these wrappers, rather than wrapping them again
+    http.client.HTTPResponse.read = wrapping(
+        _wrap_reader(_original_read, _read_bytes), _original_read
+    )
+    http.client.HTTPResponse.read1 = wrapping(
+        _wrap_reader(_original_read1, _read_bytes), _original_read1
+    )
+    http.client.HTTPResponse.readinto = wrapping(
+        _wrap_reader(_original_readinto, _readinto_bytes), _original_readinto
+    )
+    http.client.HTTPResponse.readline = wrapping(_wrap_readline, _original_readline)
+    http.client.HTTPResponse._close_conn = wrapping(
+        _wrap_close_conn, _original_close_conn
+    )
+    http.client.HTTPConnection.getresponse = wrapping(
+        _wrap_getresponse, _original_getresponse
+    )
+    http.client.HTTPConnection.request = wrapping(_wrap_request, _original_request)
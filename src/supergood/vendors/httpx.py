@@ -1,51 +1,139 @@
-import json
+import time
 from typing import Optional
-from uuid import uuid4
 
 import httpx
 
-from ..constants import REQUEST_ID_KEY
-from .helpers import DataclassesJSONEncoder, ServerSentEvent
+from ..constants import FIRST_BYTE_KEY, REQUEST_ID_KEY
+from .helpers import (
+    StreamAccumulator,
+    is_text_content,
+    new_request_id,
+    original_of,
+    wrapping,
+)
 
 
-def patch(cache_request, cache_response):
-    _original_handle_request = httpx.HTTPTransport.handle_request
-    _original_response_read = httpx.Response.read
-    _original_response_iter_lines = httpx.Response.iter_lines
-    _original_response_iter_bytes = httpx.Response.iter_bytes
+class TeeSyncStream(httpx.SyncByteStream):
+    """
+    Passes a request body through to the transport, keeping a capped copy
+    """
 
-    _original_handle_async_request = httpx.AsyncHTTPTransport.handle_async_request
-    _original_response_aread = httpx.Response.aread
-    _original_response_aiter_bytes = httpx.Response.aiter_bytes
-    _original_response_aiter_lines = httpx.Response.aiter_lines
+    def __init__(self, stream, accumulator):
+        self.stream = stream
+        self.accumulator = accumulator
 
-    def _wrap_handle_request(
-        httpTransport: httpx.HTTPTransport, request: httpx.Request
-    ):
-        request_id = str(uuid4())
+    def __iter__(self):
+        for chunk in self.stream:
+            self.accumulator.feed(chunk)
+            yield chunk
+
+    def close(self):
+        close = getattr(self.stream, "close", None)
+        if close is not None:
+            close()
+
+
+class TeeAsyncStream(httpx.AsyncByteStream):
+    """
+    Passes a request body through to the transport, keeping a capped copy
+    """
+
+    def __init__(self, stream, accumulator):
+        self.stream = stream
+        self.accumulator = accumulator
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            self.accumulator.feed(chunk)
+            yield chunk
+
+    async def aclose(self):
+        aclose = getattr(self.stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def patch(cache_request, cache_response, stream_limit=None, request_limit=None):
+    """
+    stream_limit: most bytes of a streamed response body to hold on to
+    request_limit: most bytes of a streamed request body to hold on to
+    """
+    _original_handle_request = original_of(httpx.HTTPTransport.handle_request)
+    _original_response_read = original_of(httpx.Response.read)
+    _original_response_iter_lines = original_of(httpx.Response.iter_lines)
+    _original_response_iter_bytes = original_of(httpx.Response.iter_bytes)
+
+    _original_handle_async_request = original_of(
+        httpx.AsyncHTTPTransport.handle_async_request
+    )
+    _original_response_aread = original_of(httpx.Response.aread)
+    _original_response_aiter_bytes = original_of(httpx.Response.aiter_bytes)
+    _original_response_aiter_lines = original_of(httpx.Response.aiter_lines)
+
+    def _request_body(request: httpx.Request, tee_class):
+        """
+        Returns (body, tee): body if it's already in memory, otherwise a tee
+          to swap in for request.stream, which records it as it's sent
+        """
+        if not is_text_content(request.headers.get("content-type")):
+            # binary or multipart, e.g. a file upload: don't keep any of it
+            return None, None
+        try:
+            return request.content, None
+        except httpx.RequestNotRead:
+            return None, tee_class(
+                request.stream, StreamAccumulator(limit=request_limit)
+            )
+
+    def _cache_sent_request(request, request_id, requested_at, body, tee):
+        truncation = None
+        if tee is not None:
+            # put the caller's stream back, e.g. for retries
+            request.stream = tee.stream
+            body = tee.accumulator.finish()
+            truncation = tee.accumulator.truncation
         cache_request(
             request_id,
             str(request.url),
             request.method,
-            b"".join(request.stream).decode("utf-8"),
+            body,
             request.headers,
+            requested_at=requested_at,
+            request_truncation=truncation,
         )
-        response = _original_handle_request(httpTransport, request)
+
+    def _wrap_handle_request(
+        httpTransport: httpx.HTTPTransport, request: httpx.Request
+    ):
+        requested_at = time.perf_counter_ns()
+        request_id = new_request_id()
+        body, tee = _request_body(request, TeeSyncStream)
+        if tee is not None:
+            request.stream = tee
+        try:
+            response = _original_handle_request(httpTransport, request)
+        finally:
+            # cached once sent, since a streamed body is only known by then
+            _cache_sent_request(request, request_id, requested_at, body, tee)
+        # the transport returns once the response headers are in
+        setattr(response, FIRST_BYTE_KEY, time.perf_counter_ns())
         setattr(response, REQUEST_ID_KEY, request_id)
         return response
 
     async def _wrap_handle_async_request(
         http_transport: httpx.AsyncHTTPTransport, request: httpx.Request
     ) -> httpx.Response:
-        request_id = str(uuid4())
-        cache_request(
-            request_id,
-            str(request.url),
-            request.method,
-            b"".join(request.stream).decode("utf-8"),
-            request.headers,
-        )
-        response = await _original_handle_async_request(http_transport, request)
+        requested_at = time.perf_counter_ns()
+        request_id = new_request_id()
+        body, tee = _request_body(request, TeeAsyncStream)
+        if tee is not None:
+            request.stream = tee
+        try:
+            response = await _original_handle_async_request(http_transport, request)
+        finally:
+            _cache_sent_request(request, request_id, requested_at, body, tee)
+        # the transport returns once the response headers are in
+        setattr(response, FIRST_BYTE_KEY, time.perf_counter_ns())
         setattr(response, REQUEST_ID_KEY, request_id)
         return response
 
@@ -63,6 +151,7 @@ def patch(cache_request, cache_response):
             response.headers,
             response.status_code,
             status_text,
+            first_byte_ns=getattr(response, FIRST_BYTE_KEY, None),
         )
         return response_body
 
@@ -80,6 +169,7 @@ def patch(cache_request, cache_response):
             response.headers,
             response.status_code,
             status_text,
+            first_byte_ns=getattr(response, FIRST_BYTE_KEY, None),
         )
         return response_body
 
@@ -88,20 +178,23 @@ def patch(cache_request, cache_response):
         status_text = response.extensions.get("reason_phrase", None)
         if status_text:
             status_text = status_text.decode("utf-8")
-        response_parts = []
+        accumulator = StreamAccumulator(limit=stream_limit)
         for line in _original_response_iter_lines(response):
             if line:
-                response_parts.append(line)
+                if accumulator.size:
+                    accumulator.feed(b"\n")
+                accumulator.feed(line)
             yield line
         if request_id is not None:
             # This only happens if we successfully cached the request
-            response_body = "\n".join(response_parts)
             cache_response(
                 request_id,
-                response_body,
+                accumulator.finish(),
                 response.headers,
                 response.status_code,
                 status_text,
+                first_byte_ns=getattr(response, FIRST_BYTE_KEY, None),
+                response_truncation=accumulator.truncation,
             )
 
     async def _wrap_aiter_lines(response: httpx.Response):
@@ -109,95 +202,44 @@ def patch(cache_request, cache_response):
         status_text = response.extensions.get("reason_phrase", None)
         if status_text:
             status_text = status_text.decode("utf-8")
-        response_parts = []
+        accumulator = StreamAccumulator(limit=stream_limit)
         async for line in _original_response_aiter_lines(response):
             if line:
-                response_parts.append(line)
+                if accumulator.size:
+                    accumulator.feed(b"\n")
+                accumulator.feed(line)
             yield line
         if request_id is not None:
-            response_body = "\n".join(response_parts)
             cache_response(
                 request_id,
-                response_body,
+                accumulator.finish(),
                 response.headers,
                 response.status_code,
                 status_text,
+                first_byte_ns=getattr(response, FIRST_BYTE_KEY, None),
+                response_truncation=accumulator.truncation,
             )
 
-    def _parse_sse(chunk: str):
-        data = []
-        event = None
-        id = None
-        retry = None
-
-        for line in chunk.splitlines():
-            if not line:
-                # empty newline = dispatch
-                sse = ServerSentEvent(event, data, id, retry)
-                return sse
-            if line.startswith(":"):
-                return None
-            field, _, value = line.partition(":")
-            if value.startswith(" "):
-                value = value[1:]
-            if field == "event":
-                event = value
-            elif field == "data":
-                # parse the value as json if it's serializable. otherwise use a string
-                try:
-                    serialized = json.loads(value)
-                except:
-                    serialized = value
-                data.append(serialized)
-            elif field == "id":
-                if "\0" not in value:
-                    id = value
-            elif field == "retry":
-                try:
-                    retry = int(value)
-                except (TypeError, ValueError):
-                    # what do?
-                    pass
-        # if we got to the end but didn't get a dispatch instruction, sse was invalid
-        return None
-
     def _wrap_iter_bytes(response: httpx.Response, chunk_size: Optional[int] = None):
         request_id = getattr(response, REQUEST_ID_KEY, None)
         status_text = response.extensions.get("reason_phrase", None)
         if status_text:
             status_text = status_text.decode("utf-8")
-        response_chunks = []
-        data = b""
+        # assume it's an SSE response
+        accumulator = StreamAccumulator(limit=stream_limit, sse=True)
         for chunk in _original_response_iter_bytes(response, chunk_size):
-            for line in chunk.splitlines(keepends=True):
-                data += line
-                if data.endswith((b"\r\r", b"\n\n", b"\r\n\r\n")):
-                    # assume it's an SSE response
-                    decoded = data.decode("utf-8")
-                    try:
-                        sse = _parse_sse(decoded)
-                        if sse:
-                            response_chunks.append(sse)
-                    except Exception:
-                        # failing SSE parsing, just return as string
-                        response_chunks.append(decoded)
-                    data = b""
+            accumulator.feed(chunk)
             yield chunk
         if request_id is not None:
             # Only happens if the request was successfully cached
-            if len(data):
-                # must have been an invalid chunk, append it anyway
-                response_chunks.append(data)
-            try:
-                response_body = json.dumps(response_chunks, cls=DataclassesJSONEncoder)
-            except Exception:
-                response_body = str(response_chunks)
             cache_response(
                 request_id,
-                response_body,
+                accumulator.finish(),
                 response.headers,
                 response.status_code,
                 status_text,
+                first_byte_ns=getattr(response, FIRST_BYTE_KEY, None),
+                response_truncation=accumulator.truncation,
             )
 
     async def _wrap_aiter_bytes(
@@ -207,45 +249,41 @@ def patch(cache_request, cache_response):
         status_text = response.extensions.get("reason_phrase", None)
         if status_text:
             status_text = status_text.decode("utf-8")
-        response_chunks = []
-        data = b""
+        # assume it's an SSE response
+        accumulator = StreamAccumulator(limit=stream_limit, sse=True)
         async for chunk in _original_response_aiter_bytes(response, chunk_size):
-            for line in chunk.splitlines(keepends=True):
-                data += line
-                if data.endswith((b"\r\r", b"\n\n", b"\r\n\r\n")):
-                    # assume it's an SSE response
-                    decoded = data.decode("utf-8")
-                    try:
-                        sse = _parse_sse(decoded)
-                        if sse:
-                            response_chunks.append(sse)
-                    except Exception:
-                        # failing SSE parsing, just return as string
-                        response_chunks.append(decoded)
-                    data = b""
+            accumulator.feed(chunk)
             yield chunk
         if request_id is not None:
-            if len(data):
-                # must have been an invalid chunk, append it anyway
-                response_chunks.append(data)
-            try:
-                response_body = json.dumps(response_chunks, cls=DataclassesJSONEncoder)
-            except Exception:
-                response_body = str(response_chunks)
             cache_response(
                 request_id,
-                response_body,
+                accumulator.finish(),
                 response.headers,
                 response.status_code,
                 status_text,
+                first_byte_ns=getattr(response, FIRST_BYTE_KEY, None),
+                response_truncation=accumulator.truncation,
             )
 
-    httpx.HTTPTransport.handle_request = _wrap_handle_request
-    httpx.Response.read = _wrap_response_read
-    httpx.Response.iter_lines = _wrap_iter_lines
-    httpx.Response.iter_bytes = _wrap_iter_bytes
+    # a second patch replaces these wrappers, rather than wrapping them again
+    httpx.HTTPTransport.handle_request = wrapping(
+        _wrap_handle_request, _original_handle_request
+    )
+    httpx.Response.read = wrapping(_wrap_response_read, _original_response_read)
+    httpx.Response.iter_lines = wrapping(
+        _wrap_iter_lines, _original_response_iter_lines
+    )
+    httpx.Response.iter_bytes = wrapping(
+        _wrap_iter_bytes, _original_response_iter_bytes
+    )
 
-    httpx.AsyncHTTPTransport.handle_async_request = _wrap_handle_async_request
-    httpx.Response.aread = _wrap_response_aread
-    httpx.Response.aiter_lines = _wrap_aiter_lines
-    httpx.Response.aiter_bytes = _wrap_aiter_bytes
+    httpx.AsyncHTTPTransport.handle_async_request = wrapping(
+        _wrap_handle_async_request, _original_handle_async_request
+    )
+    httpx.Response.aread = wrapping(_wrap_response_aread, _original_response_aread)
+    httpx.Response.aiter_lines = wrapping(
+        _wrap_aiter_lines, _original_response_aiter_lines
+    )
+    httpx.Response.aiter_bytes = wrapping(
+        _wrap_aiter_bytes, _original_response_aiter_bytes
+    )
@@ -1,13 +1,42 @@
-from requests import Session
+import time
+
+from requests.adapters import HTTPAdapter
+
+from .helpers import CAPTURED_ABOVE, new_request_id, original_of, wrapping
 
 
 def patch(cache_request, cache_response):
-    _original_send = Session.send
+    _original_send = original_of(HTTPAdapter.send)
 
-    # AK: The http.client.request method takes care of caching the request
-    # requests.send just wraps http.client.request
-    # TODO: See if this makes sense longer term to use, instead of http.client
-    def _wrap_send(_self, request, **kwargs):
-        return _original_send(_self, request, **kwargs)
+    # The adapter has the PreparedRequest and the Response already built, so for
+    #  non-streamed calls we capture here, and the http.client/urllib3 patches
+    #  skip the request. Streamed bodies are read by the caller, after send returns,
+    #  so those are still captured as they are read, below
+    def _wrap_send(adapter, request, *args, **kwargs):
+        stream = args[0] if args else kwargs.get("stream", False)
+        if stream or CAPTURED_ABOVE.get():
+            return _original_send(adapter, request, *args, **kwargs)
+        request_id = new_request_id()
+        cache_request(
+            request_id, request.url, request.method, request.body, request.headers
+        )
+        token = CAPTURED_ABOVE.set(True)
+        try:
+            response = _original_send(adapter, request, *args, **kwargs)
+            # send returns once the response headers are in
+            first_byte_ns = time.perf_counter_ns()
+            # Session.send would read this right after, it's cached on the response
+            response_body = response.content
+        finally:
+            CAPTURED_ABOVE.reset(token)
+        cache_response(
+            request_id=request_id,
+            response_body=response_body,
+            response_headers=response.headers,
+            response_status=response.status_code,
+            response_status_text=response.reason,
+            first_byte_ns=first_byte_ns,
+        )
+        return response
 
-    Session.send = _wrap_send
+    HTTPAdapter.send = wrapping(_wrap_send, _original_send)
@@ -1,49 +1,73 @@
 import http.client
 from importlib.metadata import version
-from uuid import uuid4
 
 import urllib3
 import urllib3.connection
 
-from ..constants import REQUEST_ID_KEY
+from ..constants import FIRST_BYTE_KEY, REQUEST_ID_KEY, RESPONSE_CAPTURE_KEY
+from .helpers import (
+    CAPTURED_ABOVE,
+    StreamAccumulator,
+    new_request_id,
+    original_of,
+    wrapping,
+)
 
 HTTPS_PORT = http.client.HTTPS_PORT
 
 
-def patch(cache_request, cache_response):
-    _original_read_chunked = urllib3.HTTPResponse.read_chunked
+def patch(cache_request, cache_response, stream_limit=None):
+    """
+    stream_limit: most bytes of a chunked response body to hold on to
+    """
+    _original_read_chunked = original_of(urllib3.HTTPResponse.read_chunked)
     _original_getheaders = http.client.HTTPResponse.getheaders
-    _original_request = urllib3.connection.HTTPConnection.request
+    _original_request = original_of(urllib3.connection.HTTPConnection.request)
 
     def _wrap_read_chunked(urllib3HttpResponse, amt=None, decode_content=None):
         response_object = urllib3HttpResponse._original_response
-        response_bytes = []
+        # urllib3 reads chunks below http.client's read methods, so capture here
+        #  and stop http.client from capturing the (empty) body when it closes
+        setattr(response_object, RESPONSE_CAPTURE_KEY, None)
+        accumulator = StreamAccumulator(limit=stream_limit)
 
         for line in _original_read_chunked(urllib3HttpResponse, amt, decode_content):
-            response_bytes.append(line)
+            accumulator.feed(line)
             yield line
 
         request_id = getattr(response_object, REQUEST_ID_KEY, None)
         if request_id is not None:
             response_headers = _original_getheaders(response_object)
-            response_body = b"".join(response_bytes)
             cache_response(
                 request_id=request_id,
-                response_body=response_body,
+                response_body=accumulator.finish(),
                 response_headers=response_headers,
                 response_status=response_object.status,
                 response_status_text=response_object.reason,
+                first_byte_ns=getattr(response_object, FIRST_BYTE_KEY, None),
+                response_truncation=accumulator.truncation,
             )
 
     def _wrap_request(http_connection, method, url, body=None, headers=None, **kwargs):
-        request_id = str(uuid4())
+        if CAPTURED_ABOVE.get():
+            # don't let the connection's previous request id leak onto this response
+            setattr(http_connection, REQUEST_ID_KEY, None)
+            return _original_request(
+                http_connection, method, url, body, headers, **kwargs
+            )
+        request_id = new_request_id()
         scheme = "https" if http_connection.port == HTTPS_PORT else "http"
         request_url = f"{scheme}://{http_connection.host}{url}"
         setattr(http_connection, REQUEST_ID_KEY, request_id)
         cache_request(request_id, request_url, method, body, headers)
         return _original_request(http_connection, method, url, body, headers, **kwargs)
 
-    urllib3.HTTPResponse.read_chunked = _wrap_read_chunked
+    # a second patch replaces these wrappers, rather than wrapping them again
+    urllib3.HTTPResponse.read_chunked = wrapping(
+        _wrap_read_chunked, _original_read_chunked
+    )
     if version("urllib3").startswith("2"):
         # This only needs to be patched in urllib3 v2+
-        urllib3.connection.HTTPConnection.request = _wrap_request
+        urllib3.connection.HTTPConnection.request = wrapping(
+            _wrap_request, _original_request
+        )
@@ -0,0 +1,55 @@
+import pytest
+import requests
+
+from supergood.api import Api
+from supergood.constants import DEFAULT_SUPERGOOD_BYTE_LIMIT, DEFAULT_SUPERGOOD_CONFIG
+from tests.helper import get_config, get_remote_config
+
+
+def get_limited_config():
+    config = get_config()
+    config["requestBodyByteLimit"] = 10
+    config["responseBodyByteLimit"] = 10
+    return config
+
+
+@pytest.mark.parametrize(
+    "supergood_client",
+    [
+        {
+            "config": get_limited_config(),
+            "remote_config": get_remote_config(
+                keys=[("responseBody.secret", "REDACT")], method="POST"
+            ),
+        }
+    ],
+    indirect=True,
+)
+class TestByteLimits:
+    def test_truncates_large_bodies(self, httpserver, supergood_client):
+        httpserver.expect_request("/200").respond_with_json({"secret": "a" * 100})
+        requests.post(httpserver.url_for("/200"), data="b" * 100)
+        requests.post(httpserver.url_for("/200"), data="small")
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 2
+        truncated = args[0]["metadata"]["truncated"]
+        assert args[0]["request"]["body"] == "b" * 10
+        assert truncated["requestBody"] == {"size": 100, "retained": 10}
+        assert truncated["responseBody"]["retained"] == 10
+        # the truncated response can't be parsed, so it is redacted entirely
+        assert args[0]["response"]["body"] is None
+        assert args[0]["metadata"]["sensitiveKeys"][0]["keyPath"] == "responseBody"
+        assert args[1]["request"]["body"] == "small"
+        assert "requestBody" not in args[1]["metadata"].get("truncated", {})
+
+    def test_limits_do_not_leak_into_defaults(self, supergood_client):
+        assert supergood_client.base_config["responseBodyByteLimit"] == 10
+        assert (
+            DEFAULT_SUPERGOOD_CONFIG["requestBodyByteLimit"]
+            == DEFAULT_SUPERGOOD_BYTE_LIMIT
+        )
+        assert (
+            DEFAULT_SUPERGOOD_CONFIG["responseBodyByteLimit"]
+            == DEFAULT_SUPERGOOD_BYTE_LIMIT
+        )
@@ -0,0 +1,88 @@
+import pytest
+import requests
+
+from supergood.api import Api
+from supergood.capture import CapturedRequest, CapturedResponse
+from supergood.constants import DEFAULT_SUPERGOOD_CONFIG
+from tests.helper import get_config, get_remote_config
+
+
+def get_deferred_config():
+    config = get_config()
+    config["deferDecoding"] = True
+    return config
+
+
+@pytest.mark.parametrize(
+    "supergood_client",
+    [
+        {
+            "config": get_deferred_config(),
+            "remote_config": get_remote_config(
+                keys=[("responseBody.secret", "REDACT")]
+            ),
+        }
+    ],
+    indirect=True,
+)
+class TestDeferredDecoding:
+    def test_caches_raw_records(self, httpserver, supergood_client):
+        httpserver.expect_request("/200").respond_with_json({"secret": "shh"})
+        requests.get(httpserver.url_for("/200"))
+        entries = list(supergood_client._response_cache.values())
+        assert len(entries) == 1
+        assert isinstance(entries[0], CapturedResponse)
+        assert isinstance(entries[0].request, CapturedRequest)
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 1
+        assert args[0]["request"]["path"] == "/200"
+        assert args[0]["response"]["status"] == 200
+        assert args[0]["response"]["body"]["secret"] is None
+        assert args[0]["metadata"]["sensitiveKeys"][0]["keyPath"] == (
+            "responseBody.secret"
+        )
+        assert len(supergood_client._response_cache) == 0
+
+    def test_force_flush_materializes_requests(self, httpserver, supergood_client):
+        httpserver.expect_request("/200").respond_with_data("ok")
+        supergood_client._cache_request(
+            "pending", httpserver.url_for("/200"), "GET", b"body", {}
+        )
+        supergood_client.flush_cache(force=True)
+        args = Api.post_events.call_args[0][0]
+        assert args[0]["request"]["id"] == "pending"
+        assert args[0]["request"]["body"] == "body"
+        assert "response" not in args[0]
+
+    def test_ignored_domains_not_captured(self, supergood_client):
+        Api.post_events.reset_mock()
+        supergood_client._cache_request(
+            "ignored", supergood_client.base_url + "/events", "GET", None, {}
+        )
+        supergood_client._cache_response("ignored", b"", {}, 200, "OK")
+        assert len(supergood_client._request_cache) == 0
+        assert len(supergood_client._response_cache) == 0
+        supergood_client.flush_cache()
+        Api.post_events.assert_not_called()
+
+    def test_raw_bodies_capped_at_capture(self, httpserver, supergood_client):
+        limit = supergood_client.base_config["responseBodyByteLimit"]
+        supergood_client._cache_request(
+            "large", httpserver.url_for("/200"), "POST", b"r" * (limit + 10), {}
+        )
+        supergood_client._cache_response("large", b"x" * (limit * 3), {}, 200, "OK")
+        (entry,) = supergood_client._response_cache.values()
+        assert len(entry.request.body) == limit
+        assert len(entry.body) == limit
+        assert entry.truncation == {"size": limit * 3, "retained": limit}
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        truncated = args[0]["metadata"]["truncated"]
+        assert truncated["requestBody"]["size"] == limit + 10
+        assert truncated["responseBody"]["size"] == limit * 3
+        assert len(args[0]["response"]["body"]) == limit
+
+    def test_config_does_not_leak_into_defaults(self, supergood_client):
+        assert supergood_client.base_config["deferDecoding"] is True
+        assert DEFAULT_SUPERGOOD_CONFIG["deferDecoding"] is False
@@ -0,0 +1,186 @@
+import random
+import threading
+
+import pytest
+import requests
+
+from supergood.api import Api
+from supergood.capture import EventBuffer, ShardedEventBuffer
+from tests.helper import get_config
+
+
+def get_small_buffer_config():
+    config = get_config()
+    config["eventBufferMaxEvents"] = 2
+    config["eventBufferByteLimit"] = 1000000
+    config["eventBufferOverflowPolicy"] = "drop-newest"
+    return config
+
+
+def fill(buffer, count, size=0):
+    return [buffer.put(str(i), {"event": i}, size) for i in range(count)]
+
+
+def test_unbounded_buffer_keeps_everything():
+    buffer = EventBuffer()
+    assert all(fill(buffer, 100, 10))
+    assert len(buffer) == 100
+    assert buffer.stats() == {"size": 100, "bytes": 1000, "dropped": 0}
+
+
+def test_drop_newest_rejects_events_past_the_limit():
+    buffer = EventBuffer(max_events=3, policy="drop-newest")
+    assert fill(buffer, 5) == [True, True, True, False, False]
+    assert buffer.keys() == ["0", "1", "2"]
+    assert buffer.stats()["dropped"] == 2
+
+
+def test_drop_oldest_evicts_until_new_event_fits():
+    buffer = EventBuffer(max_bytes=30, policy="drop-oldest")
+    assert all(fill(buffer, 3, 10))
+    assert buffer.put("big", {"event": "big"}, 25)
+    assert buffer.keys() == ["big"]
+    assert buffer.bytes == 25
+    assert buffer.stats()["dropped"] == 3
+
+
+def test_event_larger_than_limit_is_dropped():
+    buffer = EventBuffer(max_bytes=30, policy="drop-oldest")
+    fill(buffer, 2, 10)
+    assert not buffer.put("huge", {"event": "huge"}, 31)
+    assert buffer.keys() == ["0", "1"]
+
+
+def test_sample_down_keeps_a_uniform_sample():
+    random.seed(7)
+    counts = [0] * 10
+    for _ in range(2000):
+        buffer = EventBuffer(max_events=2, policy="sample-down")
+        fill(buffer, 10)
+        assert len(buffer) == 2
+        assert buffer.stats()["dropped"] == 8
+        for event in buffer.values():
+            counts[event["event"]] += 1
+    # each event is kept 2 / 10 of the time, 400 times in expectation
+    assert all(300 < count < 500 for count in counts)
+
+
+def test_pop_frees_room():
+    buffer = EventBuffer(max_events=2, policy="drop-newest")
+    fill(buffer, 2, 5)
+    assert buffer.pop("0") == {"event": 0}
+    assert buffer.pop("0") is None
+    assert buffer.bytes == 5
+    assert buffer.put("2", {"event": 2})
+    assert buffer.keys() == ["1", "2"]
+
+
+def test_swap_takes_everything_and_leaves_buffer_empty():
+    buffer = EventBuffer(max_events=3, policy="drop-newest")
+    fill(buffer, 3, 5)
+    assert buffer.swap() == [{"event": 0}, {"event": 1}, {"event": 2}]
+    assert len(buffer) == 0
+    assert buffer.bytes == 0
+    # the emptied buffer takes new events up to its limit again
+    assert all(fill(buffer, 3))
+    assert buffer.stats()["dropped"] == 0
+
+
+def test_sharded_buffer_gives_each_thread_its_own_shard():
+    buffer = ShardedEventBuffer(4, max_events=8, policy="drop-newest")
+
+    def write(thread_index):
+        for i in range(2):
+            buffer.put(f"{thread_index}-{i}", {"event": thread_index})
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [len(shard) for shard in buffer.shards] == [2, 2, 2, 2]
+    assert buffer.stats() == {"size": 8, "bytes": 0, "dropped": 0}
+    # the limit is on the whole buffer
+    assert not buffer.put("main-0", {"event": "main"})
+    assert buffer.stats()["dropped"] == 1
+    assert len(buffer.swap()) == 8
+    assert len(buffer) == 0
+
+
+def test_one_thread_fills_a_sharded_buffer_to_its_limits():
+    buffer = ShardedEventBuffer(16, max_events=100, policy="drop-newest")
+    assert all(fill(buffer, 100))
+    assert not buffer.put("100", {"event": 100})
+    assert len(buffer) == 100
+    assert buffer.stats()["dropped"] == 1
+    buffer = ShardedEventBuffer(16, max_bytes=1000, policy="drop-newest")
+    assert buffer.put("large", {"event": "large"}, 900)
+    assert all(fill(buffer, 10, 10))
+    assert not buffer.put("over", {"event": "over"}, 1)
+    assert buffer.bytes == 1000
+
+
+def test_sharded_drop_oldest_evicts_from_the_writing_shard():
+    buffer = ShardedEventBuffer(4, max_events=10, policy="drop-oldest")
+    assert all(fill(buffer, 12))
+    assert buffer.keys() == [str(i) for i in range(2, 12)]
+    assert buffer.stats()["dropped"] == 2
+
+
+def test_sharded_sample_down_keeps_a_uniform_sample():
+    random.seed(7)
+    counts = [0] * 10
+    for _ in range(2000):
+        buffer = ShardedEventBuffer(4, max_events=2, policy="sample-down")
+        fill(buffer, 10)
+        assert len(buffer) == 2
+        for event in buffer.values():
+            counts[event["event"]] += 1
+    assert all(300 < count < 500 for count in counts)
+
+
+@pytest.mark.parametrize(
+    "supergood_client", [{"config": get_small_buffer_config()}], indirect=True
+)
+class TestEventBufferLimits:
+    def test_drops_events_past_the_limit(self, httpserver, supergood_client):
+        httpserver.expect_request("/200").respond_with_data("ok")
+        for _ in range(3):
+            requests.get(httpserver.url_for("/200"))
+        assert len(supergood_client._response_cache) == 2
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 2
+        telemetry = Api.post_telemetry.call_args[0][0]
+        assert telemetry["eventBufferDrops"] == 1
+        assert len(supergood_client._response_cache) == 0
+
+    def test_events_buffered_during_flush_are_kept(self, httpserver, supergood_client):
+        httpserver.expect_request("/200").respond_with_data("ok")
+        requests.get(httpserver.url_for("/200"))
+
+        def post_events(events):
+            # a request thread finishing while the batch is being posted
+            requests.get(httpserver.url_for("/200"))
+
+        Api.post_events.side_effect = post_events
+        try:
+            supergood_client.flush_cache()
+        finally:
+            Api.post_events.side_effect = None
+        assert len(Api.post_events.call_args[0][0]) == 1
+        assert len(supergood_client._response_cache) == 1
+        supergood_client.flush_cache()
+        assert len(supergood_client._response_cache) == 0
+
+    def test_large_downloads_counted_as_truncated(self, httpserver, supergood_client):
+        limit = supergood_client.base_config["responseBodyByteLimit"]
+        httpserver.expect_request("/large").respond_with_data("x" * 4000000)
+        requests.get(httpserver.url_for("/large"))
+        # only the truncated body is kept, so it fits the buffer
+        assert supergood_client._response_cache.stats()["bytes"] < 1000000
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 1
+        assert args[0]["metadata"]["truncated"]["responseBody"]["size"] == 4000000
+        assert len(args[0]["response"]["body"]) == limit
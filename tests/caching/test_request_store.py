@@ -0,0 +1,115 @@
+import pytest
+
+from supergood.api import Api
+from supergood.capture import RequestStore, ShardedRequestStore, estimate_size
+from tests.helper import get_config
+
+
+def get_expiring_config():
+    config = get_config()
+    config["requestCacheTtl"] = 0
+    config["emitExpiredRequests"] = True
+    return config
+
+
+def test_pop_returns_entry_and_frees_bytes():
+    store = RequestStore()
+    store.put("a", {"request": 1}, 10)
+    assert len(store) == 1
+    assert store.bytes == 10
+    assert store.pop("a") == {"request": 1}
+    assert store.pop("a") is None
+    assert store.bytes == 0
+
+
+def test_replacing_an_entry_keeps_bytes_accurate():
+    store = RequestStore()
+    store.put("a", "first", 10)
+    store.put("a", "second", 4)
+    assert store.bytes == 4
+    assert store.values() == ["second"]
+
+
+def test_oldest_entries_evicted_past_byte_limit():
+    store = RequestStore(max_bytes=25)
+    for request_id in ["a", "b", "c"]:
+        store.put(request_id, request_id, 10)
+    assert store.keys() == ["b", "c"]
+    assert store.bytes == 20
+    assert store.stats()["evictions"] == 1
+
+
+def test_newest_entry_kept_even_if_over_limit():
+    store = RequestStore(max_bytes=5)
+    store.put("a", "a", 1)
+    store.put("b", "b", 50)
+    assert store.keys() == ["b"]
+
+
+def test_expire_removes_only_old_entries():
+    store = RequestStore(ttl=1000)
+    store.put("a", "a", 3)
+    store.put("b", "b", 4)
+    _, stored_at, _ = store._entries["b"]
+    store._entries["a"] = ("a", stored_at - 5000, 3)
+    assert store.expire(now=stored_at + 10) == ["a"]
+    assert store.keys() == ["b"]
+    assert store.bytes == 4
+    assert store.stats()["expirations"] == 1
+
+
+def test_expire_without_ttl_keeps_everything():
+    store = RequestStore()
+    store.put("a", "a")
+    assert store.expire() == []
+    assert len(store) == 1
+
+
+def test_drain_empties_the_store():
+    store = RequestStore(max_bytes=100)
+    store.put("a", "a", 10)
+    store.put("b", "b", 20)
+    assert store.drain() == ["a", "b"]
+    assert len(store) == 0
+    assert store.bytes == 0
+
+
+def test_sharded_store_finds_requests_by_id():
+    store = ShardedRequestStore(4, max_bytes=40)
+    assert [shard.max_bytes for shard in store.shards] == [10, 10, 10, 10]
+    for request_id in range(8):
+        store.put(request_id, f"request {request_id}", 5)
+    assert [len(shard) for shard in store.shards] == [2, 2, 2, 2]
+    assert store.take(6) == ("request 6", 5)
+    assert store.pop("missing") is None
+    assert store.stats()["bytes"] == 35
+    assert sorted(store.drain()) == [f"request {i}" for i in [0, 1, 2, 3, 4, 5, 7]]
+    assert len(store) == 0
+
+
+def test_estimate_size():
+    assert estimate_size("http://a", b"body") == 12
+    assert estimate_size(b"http://a", None) == 8
+    assert estimate_size("http://a", iter([b"streamed"])) == 8
+
+
+@pytest.mark.parametrize(
+    "supergood_client", [{"config": get_expiring_config()}], indirect=True
+)
+class TestExpiredRequests:
+    def test_expired_requests_posted_without_response(
+        self, httpserver, supergood_client
+    ):
+        supergood_client._cache_request(
+            "orphan", httpserver.url_for("/200"), "GET", b"body", {}
+        )
+        assert len(supergood_client._request_cache) == 1
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 1
+        assert args[0]["request"]["path"] == "/200"
+        assert args[0]["metadata"]["expired"] is True
+        assert "response" not in args[0]
+        assert len(supergood_client._request_cache) == 0
+        telemetry = Api.post_telemetry.call_args[0][0]
+        assert telemetry["requestCacheExpirations"] >= 1
@@ -4,12 +4,13 @@ from supergood import Client
 from tests.helper import get_config, get_remote_config
 
 
-@pytest.fixture(scope="session")
-def broken_redaction(session_mocker):
-    session_mocker.patch(
+@pytest.fixture(scope="module")
+def broken_redaction(module_mocker):
+    # module scoped, so redaction is only broken for the tests that ask for it
+    module_mocker.patch(
         "supergood.client.redact_values", side_effect=Exception
     ).start()
-    yield session_mocker
+    yield module_mocker
 
 
 @pytest.fixture(scope="session")
@@ -18,7 +19,7 @@ def monkeysession():
         yield mp
 
 
-@pytest.fixture(scope="session")
+@pytest.fixture(scope="module")
 def broken_client(broken_redaction, monkeysession):
     config = get_config()
     remote_config = get_remote_config()
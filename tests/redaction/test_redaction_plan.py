@@ -0,0 +1,132 @@
+import pytest
+
+from supergood.helpers import redact_all, redact_plan
+from supergood.remote_config import (
+    SensitiveKey,
+    compile_redaction_path,
+    compile_redaction_plan,
+    parse_remote_config_json,
+)
+from tests.helper import get_remote_config
+
+
+class TestRedactionPlan:
+    def test_compile_redaction_path(self):
+        path = compile_redaction_path(
+            SensitiveKey("responseBody[].items[].card.number", "REDACT")
+        )
+        assert path.section == ("response", "body")
+        assert path.root_array
+        assert path.segments == [("items", True), ("card", False), ("number", False)]
+
+    def test_redact_plan_skips_missing_keys(self):
+        event = {
+            "request": {"body": ""},
+            "response": {
+                "body": {
+                    "items": [
+                        {"card": {"number": "4242"}},
+                        {"card": {}},
+                        {"other": "value"},
+                        {"card": {"number": 12}},
+                    ]
+                }
+            },
+        }
+        plan = compile_redaction_plan(
+            [SensitiveKey("responseBody.items[].card.number", "REDACT")]
+        )
+        skeys = redact_plan(event, plan)
+        assert skeys == [
+            {
+                "keyPath": "responseBody.items[0].card.number",
+                "type": "string",
+                "length": 4,
+            },
+            {
+                "keyPath": "responseBody.items[3].card.number",
+                "type": "integer",
+                "length": 2,
+            },
+        ]
+        items = event["response"]["body"]["items"]
+        assert items == [
+            {"card": {"number": None}},
+            {"card": {}},
+            {"other": "value"},
+            {"card": {"number": None}},
+        ]
+
+    def test_redact_plan_unknown_section(self):
+        path = compile_redaction_path(SensitiveKey("somewhere.key", "REDACT"))
+        assert path.section is None
+        plan = compile_redaction_plan([SensitiveKey("somewhere.key", "REDACT")])
+        with pytest.raises(Exception):
+            redact_plan({"request": {}}, plan)
+
+    def test_redact_plan_applies_keys_in_config_order(self):
+        event = {
+            "request": {"headers": {"authorization": "secret"}},
+            "response": {
+                "body": {
+                    "items": [{"a": "1", "b": "22"}, {"a": "333", "b": "4444"}],
+                    "nested": {"inner": "x"},
+                },
+            },
+        }
+        plan = compile_redaction_plan(
+            [
+                SensitiveKey("responseBody.items[].b", "REDACT"),
+                SensitiveKey("responseBody.nested", "REDACT"),
+                # already redacted as part of responseBody.nested
+                SensitiveKey("responseBody.nested.inner", "REDACT"),
+                SensitiveKey("requestHeaders.authorization", "REDACT"),
+                SensitiveKey("responseBody.items[].a", "REDACT"),
+            ]
+        )
+        skeys = redact_plan(event, plan)
+        assert [key["keyPath"] for key in skeys] == [
+            "responseBody.items[0].b",
+            "responseBody.items[1].b",
+            "responseBody.nested",
+            "requestHeaders.authorization",
+            "responseBody.items[0].a",
+            "responseBody.items[1].a",
+        ]
+        assert event["response"]["body"] == {
+            "items": [{"a": None, "b": None}, {"a": None, "b": None}],
+            "nested": None,
+        }
+        assert event["request"]["headers"] == {"authorization": None}
+
+    def test_redact_all_allowed_keys(self):
+        remote_config = parse_remote_config_json(
+            get_remote_config(
+                keys=[
+                    ("responseBody[].data[].id", "ALLOW"),
+                    ("requestHeaders.accept", "ALLOW"),
+                ]
+            )
+        )
+        event = {
+            "request": {"body": "raw", "headers": {"accept": "*/*", "cookie": "c"}},
+            "response": {
+                "body": [{"data": [{"id": 1, "name": "ab"}, [["x"]]]}],
+                "headers": {},
+            },
+            "metadata": {"vendorId": "vendor-id", "endpointId": "endpoint-id"},
+        }
+        redact_all([event], remote_config, by_default=True)
+        assert event["request"] == {
+            "body": None,
+            "headers": {"accept": "*/*", "cookie": None},
+        }
+        assert event["response"]["body"] == [
+            {"data": [{"id": 1, "name": None}, [[None]]]}
+        ]
+        assert [key["keyPath"] for key in event["metadata"]["sensitiveKeys"]] == [
+            "requestBody",
+            "requestHeaders.cookie",
+            "responseBody[0].data[0].name",
+            "responseBody[0].data[1][0][0]",
+        ]
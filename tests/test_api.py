@@ -0,0 +1,31 @@
+import json
+
+from pytest_httpserver import HTTPServer
+from werkzeug.wrappers import Response
+
+from supergood.api import Api
+from tests.helper import get_remote_config
+
+
+class TestApi:
+    def test_config_pull_uses_etag(self, httpserver: HTTPServer):
+        remote_config = get_remote_config()
+
+        def handler(request):
+            if request.headers.get("If-None-Match") == '"v1"':
+                return Response(status=304)
+            return Response(
+                json.dumps(remote_config),
+                headers={"ETag": '"v1"'},
+                content_type="application/json",
+            )
+
+        httpserver.expect_request("/config").respond_with_handler(handler)
+        api = Api({}, base_url=httpserver.url_for("/"))
+        api.set_config_pull_url("/config")
+        assert api.get_config() == remote_config
+        assert api.config_etag == '"v1"'
+        # unchanged config, nothing to parse
+        assert api.get_config() is None
+        api.config_etag = None
+        assert api.get_config() == remote_config
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+from supergood.remote_config import (
+    load_remote_config_snapshot,
+    save_remote_config_snapshot,
+)
+from tests.helper import get_config, get_remote_config
+
+SNAPSHOT_DIR = tempfile.mkdtemp()
+
+
+def get_snapshot_config():
+    config = get_config()
+    config["remoteConfigCacheDir"] = SNAPSHOT_DIR
+    return config
+
+
+class TestConfigSnapshot:
+    def test_snapshot_round_trip(self):
+        path = os.path.join(tempfile.mkdtemp(), "nested", "config.json")
+        remote_config = get_remote_config()
+        assert load_remote_config_snapshot(path) is None
+        save_remote_config_snapshot(path, remote_config, etag='"v1"')
+        assert load_remote_config_snapshot(path) == (remote_config, '"v1"')
+        # too old to use
+        stale = time.time() - 100
+        os.utime(path, (stale, stale))
+        assert load_remote_config_snapshot(path, max_age=10) is None
+
+    @pytest.mark.parametrize(
+        "supergood_client", [{"config": get_snapshot_config()}], indirect=True
+    )
+    def test_client_loads_snapshot(self, supergood_client):
+        path = supergood_client.remote_config_snapshot_path
+        assert path.startswith(SNAPSHOT_DIR)
+        # written by the config pull when the client started
+        assert load_remote_config_snapshot(path) is not None
+        supergood_client.remote_config = None
+        supergood_client._load_config_snapshot()
+        assert supergood_client.remote_config["vendor-id"] is not None
@@ -0,0 +1,63 @@
+import gzip
+import sys
+
+from supergood.helpers import (
+    cap_raw_body,
+    combine_truncation,
+    describe_data,
+    recursive_size,
+    truncate_body,
+)
+
+
+class TestHelpers:
+    def test_recursive_size_is_repeatable(self):
+        obj = {"param1": "value1", "param2": 2, "nested": {"param1": [1, 2]}}
+        expected = (
+            sys.getsizeof("param1") * 2
+            + sys.getsizeof("param2")
+            + sys.getsizeof("nested")
+            + sys.getsizeof("value1")
+            + sys.getsizeof(2)
+            + sys.getsizeof([1, 2])
+        )
+        # sizes used to be skipped for any object measured by an earlier call
+        for _ in range(3):
+            assert recursive_size(obj) == expected
+            assert describe_data(obj) == ("object", expected)
+
+    def test_recursive_size_handles_cycles(self):
+        obj = {"key": "value"}
+        obj["self"] = obj
+        assert recursive_size(obj) == (
+            sys.getsizeof("key") + sys.getsizeof("self") + sys.getsizeof("value")
+        )
+
+    def test_truncate_body(self):
+        assert truncate_body(b"0123456789", 10) == (b"0123456789", None)
+        assert truncate_body(b"0123456789", 4) == ("0123", {"size": 10, "retained": 4})
+        assert truncate_body("0123456789", 4) == ("0123", {"size": 10, "retained": 4})
+        assert truncate_body(b"0123456789", None) == (b"0123456789", None)
+
+    def test_truncate_gzipped_body(self):
+        body = gzip.compress(b"a" * 1000)
+        assert truncate_body(body, 2000) == (b"a" * 1000, None)
+        retained, truncation = truncate_body(body, 10)
+        assert retained == "a" * 10
+        assert truncation == {"size": len(body), "retained": 10, "gzip": True}
+
+    def test_cap_raw_body(self):
+        assert cap_raw_body(b"abcdef", 4) == (b"abcd", {"size": 6, "retained": 4})
+        assert cap_raw_body("abc", 4) == ("abc", None)
+        assert cap_raw_body(b"abcdef", None) == (b"abcdef", None)
+        stream = iter([b"chunk"])
+        assert cap_raw_body(stream, 1) == (stream, None)
+
+    def test_combine_truncation_keeps_full_size(self):
+        streamed = {"size": 100, "retained": 50}
+        assert combine_truncation(streamed, None) == streamed
+        assert combine_truncation(None, streamed) == streamed
+        assert combine_truncation(streamed, {"size": 50, "retained": 10}) == {
+            "size": 100,
+            "retained": 10,
+        }
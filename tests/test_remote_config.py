@@ -3,7 +3,11 @@ import re
 import requests
 
 from supergood.api import Api
-from supergood.remote_config import parse_remote_config_json
+from supergood.remote_config import (
+    MatchCache,
+    get_vendor_endpoint_from_config,
+    parse_remote_config_json,
+)
 from tests.helper import get_remote_config
 
 
@@ -26,8 +30,8 @@ class TestRemoteConfig:
         supergood_client.remote_config = None  # config not pulled
         httpserver.expect_request("/200").respond_with_json({"key": "val"})
         requests.get(httpserver.url_for("/200"))
-        assert supergood_client._request_cache == {}
-        assert supergood_client._response_cache == {}
+        assert len(supergood_client._request_cache) == 0
+        assert len(supergood_client._response_cache) == 0
         supergood_client._get_config()  # Now there's a config
         httpserver.expect_request("/200").respond_with_json({"key": "val"})
         requests.get(httpserver.url_for("/200"))
@@ -35,3 +39,164 @@ class TestRemoteConfig:
         args = Api.post_events.call_args[0][0]
         assert len(args) == 1
         assert args[0]["response"]["body"] == {"key": "val"}
+
+    def test_matcher_resolves_vendor_by_domain_suffix(self):
+        remote_config = get_remote_config()
+        remote_config[0]["domain"] = "stripe.com"
+        parsed_config = parse_remote_config_json(remote_config)
+        vendor, endpoint = get_vendor_endpoint_from_config(
+            parsed_config, url="https://api.stripe.com/v1/200", method="GET"
+        )
+        assert vendor.vendor_id == "vendor-id"
+        assert endpoint.endpoint_id == "endpoint-id"
+        vendor, endpoint = get_vendor_endpoint_from_config(
+            parsed_config, url="https://api.example.com/v1/200", method="GET"
+        )
+        assert vendor is None and endpoint is None
+
+    def test_matcher_keeps_endpoint_order_across_locations(self):
+        remote_config = get_remote_config(location="requestBody", regex="needle")
+        endpoints = remote_config[0]["endpoints"]
+        endpoints.append(
+            {
+                "id": "path-endpoint",
+                "method": "GET",
+                "matchingRegex": {"location": "path", "regex": "200"},
+            }
+        )
+        parsed_config = parse_remote_config_json(remote_config)
+        url = "http://localhost:8080/200"
+        _, endpoint = get_vendor_endpoint_from_config(
+            parsed_config, url=url, method="GET", request_body="needle"
+        )
+        assert endpoint.endpoint_id == "endpoint-id"
+        _, endpoint = get_vendor_endpoint_from_config(
+            parsed_config, url=url, method="GET", request_body="hay"
+        )
+        assert endpoint.endpoint_id == "path-endpoint"
+        _, endpoint = get_vendor_endpoint_from_config(
+            parsed_config, url=url, method="POST", request_body="needle"
+        )
+        assert endpoint is None
+
+    def test_match_cache_hits_and_negative_results(self):
+        parsed_config = parse_remote_config_json(get_remote_config())
+        cache = MatchCache(16)
+        for _ in range(3):
+            _, endpoint = get_vendor_endpoint_from_config(
+                parsed_config, url="http://localhost/200", method="GET", cache=cache
+            )
+            assert endpoint.endpoint_id == "endpoint-id"
+            vendor, _ = get_vendor_endpoint_from_config(
+                parsed_config, url="http://example.com/200", method="GET", cache=cache
+            )
+            assert vendor is None
+        assert cache.stats() == {"hits": 4, "misses": 2, "bypasses": 0, "size": 2}
+
+    def test_match_cache_bypasses_payload_locations(self):
+        parsed_config = parse_remote_config_json(
+            get_remote_config(location="requestBody", regex="needle")
+        )
+        cache = MatchCache(16)
+        for body in ["needle", "hay"]:
+            _, endpoint = get_vendor_endpoint_from_config(
+                parsed_config,
+                url="http://localhost/200",
+                method="GET",
+                request_body=body,
+                cache=cache,
+            )
+            assert (endpoint is not None) == (body == "needle")
+        assert cache.stats() == {"hits": 0, "misses": 0, "bypasses": 2, "size": 0}
+
+    def test_match_cache_invalidated_by_new_config(self, supergood_client):
+        cache = supergood_client.match_cache
+        url = "http://localhost/200"
+        supergood_client._get_config()
+        get_vendor_endpoint_from_config(
+            supergood_client.remote_config, url=url, method="GET", cache=cache
+        )
+        size = cache.stats()["size"]
+        assert size > 0
+        # an unchanged config is not reinstalled
+        supergood_client._get_config()
+        assert cache.stats()["size"] == size
+        original_config = Api.get_config.return_value
+        Api.get_config.return_value = get_remote_config(regex="201")
+        try:
+            supergood_client._get_config()
+        finally:
+            Api.get_config.return_value = original_config
+        assert cache.stats()["size"] == 0
+        misses = cache.stats()["misses"]
+        get_vendor_endpoint_from_config(
+            supergood_client.remote_config, url=url, method="GET", cache=cache
+        )
+        assert cache.stats()["misses"] == misses + 1
+        supergood_client._get_config()
+
+    def test_matcher_groups_endpoints_per_location(self):
+        remote_config = get_remote_config(location="requestBody", regex="needle")
+        endpoints = remote_config[0]["endpoints"]
+        for index, regex in enumerate([r"(\w)\1", "hay", "ne+dle"]):
+            endpoints.append(
+                {
+                    "id": f"endpoint-{index}",
+                    "method": "GET",
+                    "matchingRegex": {"location": "requestBody", "regex": regex},
+                }
+            )
+        del endpoints[1]
+        parsed_config = parse_remote_config_json(remote_config)
+        (group,) = parsed_config.matcher._groups["vendor-id"]["get"]
+        assert [ordinal for (ordinal, _) in group.endpoints] == [0, 1, 2]
+        url = "http://localhost/200"
+        for body, endpoint_id in [
+            ("a needle in the hay", "endpoint-id"),
+            ("hay with a neeedle", "endpoint-1"),
+            ("neeedle", "endpoint-2"),
+        ]:
+            _, endpoint = get_vendor_endpoint_from_config(
+                parsed_config, url=url, method="GET", request_body=body
+            )
+            assert endpoint.endpoint_id == endpoint_id
+
+    def test_reparse_reuses_unchanged_config(self):
+        remote_config = get_remote_config()
+        remote_config.append(
+            {
+                "domain": "example.com",
+                "id": "other-vendor-id",
+                "endpoints": [
+                    {
+                        "id": "other-endpoint-id",
+                        "method": "GET",
+                        "matchingRegex": {"location": "path", "regex": "other"},
+                    }
+                ],
+            }
+        )
+        parsed_config = parse_remote_config_json(remote_config)
+        assert parse_remote_config_json(remote_config, parsed_config) is parsed_config
+
+        remote_config[0]["endpoints"][0]["endpointConfiguration"]["action"] = "Ignore"
+        reparsed_config = parse_remote_config_json(remote_config, parsed_config)
+        assert reparsed_config is not parsed_config
+        assert reparsed_config["other-vendor-id"] is parsed_config["other-vendor-id"]
+        old_endpoint = parsed_config["vendor-id"].endpoints["endpoint-id"]
+        new_endpoint = reparsed_config["vendor-id"].endpoints["endpoint-id"]
+        assert new_endpoint.action == "Ignore"
+        assert new_endpoint.regex is old_endpoint.regex
+        assert (
+            reparsed_config.matcher._groups["other-vendor-id"]
+            is parsed_config.matcher._groups["other-vendor-id"]
+        )
+
+    def test_remote_config_parse_byte_limits(self):
+        remote_config = get_remote_config()
+        endpoint_config = remote_config[0]["endpoints"][0]["endpointConfiguration"]
+        endpoint_config["responseBodyByteLimit"] = 1024
+        parsed_config = parse_remote_config_json(remote_config)
+        endpoint = parsed_config["vendor-id"].endpoints["endpoint-id"]
+        assert endpoint.request_body_byte_limit is None
+        assert endpoint.response_body_byte_limit == 1024
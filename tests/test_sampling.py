@@ -0,0 +1,140 @@
+import pytest
+import requests
+
+from supergood.api import Api
+from supergood.remote_config import parse_remote_config_json
+from supergood.sampling import TailSampler, is_sampled, normalize_sample_rate
+from tests.helper import get_config, get_remote_config
+
+
+def get_sampled_remote_config(sample_rate):
+    remote_config = get_remote_config()
+    remote_config[0]["endpoints"][0]["endpointConfiguration"][
+        "sampleRate"
+    ] = sample_rate
+    return remote_config
+
+
+def test_normalize_sample_rate():
+    assert normalize_sample_rate(None) is None
+    assert normalize_sample_rate(2) == 1.0
+    assert normalize_sample_rate(-1) == 0.0
+    assert normalize_sample_rate("0.25") == 0.25
+
+
+def test_is_sampled(mocker):
+    assert is_sampled(1.0)
+    assert not is_sampled(0.0)
+    mocker.patch("supergood.sampling.random.random", return_value=0.3)
+    assert is_sampled(0.5)
+    assert not is_sampled(0.2)
+
+
+def test_tail_sampler_rules(mocker):
+    sampler = TailSampler(
+        0.0,
+        status_classes=frozenset([5]),
+        latency_threshold=500,
+        endpoint_ids=frozenset(["endpoint-id"]),
+    )
+    assert sampler.keep(503, 10) == (True, False)
+    assert sampler.keep(200, 501) == (True, False)
+    assert sampler.keep(200, 10, "endpoint-id") == (True, False)
+    assert sampler.keep(200, 10, "other-id") == (False, True)
+    assert sampler.keep(None, 10) == (False, True)
+    sampler.sample_rate = 0.5
+    mocker.patch("supergood.sampling.random.random", return_value=0.2)
+    assert sampler.keep(404, 10) == (True, True)
+
+
+def test_tail_sampler_from_config():
+    config = get_config()
+    config["tailSampleRate"] = 1.0
+    config["tailSampleStatusClasses"] = ["5xx", 4]
+    config["tailSampleLatencyThreshold"] = None
+    config["tailSampleEndpointIds"] = []
+    assert TailSampler.from_config(config) is None
+    config["tailSampleRate"] = 0.1
+    sampler = TailSampler.from_config(config)
+    assert sampler.sample_rate == 0.1
+    assert sampler.status_classes == frozenset([4, 5])
+
+
+def test_parses_endpoint_sample_rate():
+    config = parse_remote_config_json(get_sampled_remote_config(0.1))
+    assert config["vendor-id"].endpoints["endpoint-id"].sample_rate == 0.1
+    config = parse_remote_config_json(get_remote_config())
+    assert config["vendor-id"].endpoints["endpoint-id"].sample_rate is None
+
+
+@pytest.mark.parametrize(
+    "supergood_client",
+    [
+        {
+            "config": get_config(),
+            "remote_config": get_sampled_remote_config(0.5),
+        }
+    ],
+    indirect=True,
+)
+class TestSampling:
+    def test_endpoint_sample_rate(self, httpserver, supergood_client, mocker):
+        httpserver.expect_request("/200").respond_with_data("ok")
+        httpserver.expect_request("/other").respond_with_data("ok")
+        mocker.patch("supergood.sampling.random.random", return_value=0.7)
+        requests.get(httpserver.url_for("/200"))  # dropped
+        requests.get(httpserver.url_for("/other"))  # no endpoint, global rate of 1
+        mocker.patch("supergood.sampling.random.random", return_value=0.2)
+        requests.get(httpserver.url_for("/200"))  # kept
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 2
+        assert args[0]["request"]["path"] == "/other"
+        assert "sampleRate" not in args[0]["metadata"]
+        assert args[1]["request"]["path"] == "/200"
+        assert args[1]["metadata"]["sampleRate"] == 0.5
+
+    def test_global_sample_rate(self, httpserver, supergood_client, mocker):
+        httpserver.expect_request("/other").respond_with_data("ok")
+        mocker.patch.object(supergood_client, "sample_rate", 0.0)
+        Api.post_events.reset_mock()
+        requests.get(httpserver.url_for("/other"))
+        supergood_client.flush_cache()
+        Api.post_events.assert_not_called()
+
+
+def get_tail_sampled_config():
+    config = get_config()
+    config["tailSampleRate"] = 0.0
+    config["tailSampleStatusClasses"] = [5]
+    config["tailSampleLatencyThreshold"] = 60000
+    return config
+
+
+@pytest.mark.parametrize(
+    "supergood_client",
+    [{"config": get_tail_sampled_config()}],
+    indirect=True,
+)
+class TestTailSampling:
+    def test_keeps_errors_drops_the_rest(self, httpserver, supergood_client):
+        httpserver.expect_request("/200").respond_with_data("ok")
+        httpserver.expect_request("/500").respond_with_data("bad", status=500)
+        requests.get(httpserver.url_for("/200"))
+        requests.get(httpserver.url_for("/500"))
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 1
+        assert args[0]["response"]["status"] == 500
+        assert "sampleRate" not in args[0]["metadata"]
+        assert args[0]["response"]["duration"] >= 0
+
+    def test_records_combined_rate(self, httpserver, supergood_client, mocker):
+        httpserver.expect_request("/other").respond_with_data("ok")
+        mocker.patch.object(supergood_client.tail_sampler, "sample_rate", 0.5)
+        mocker.patch.object(supergood_client, "sample_rate", 0.5)
+        mocker.patch("supergood.sampling.random.random", return_value=0.2)
+        requests.get(httpserver.url_for("/other"))
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert args[0]["metadata"]["sampleRate"] == 0.25
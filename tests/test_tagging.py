@@ -0,0 +1,60 @@
+import asyncio
+import contextvars
+
+from supergood.api import Api
+
+
+def test_nested_tags_are_merged_once(supergood_client):
+    with supergood_client.tagging({"m": "mini"}):
+        with supergood_client.tagging({"w": "wumbo"}):
+            tags = supergood_client._current_tags()
+            assert tags == {"m": "mini", "w": "wumbo"}
+            # the same snapshot every time, nothing is merged per capture
+            assert supergood_client._current_tags() is tags
+        assert supergood_client._current_tags() == {"m": "mini"}
+    assert supergood_client._current_tags() is None
+
+
+def test_non_dict_tags_are_wrapped(supergood_client):
+    with supergood_client.tagging("banjo"):
+        assert supergood_client._current_tags() == {"tags": "banjo"}
+
+
+def test_tags_do_not_bleed_between_tasks(supergood_client):
+    async def tagged(name):
+        with supergood_client.tagging({"task": name}):
+            # let the other task enter its own block before reading tags
+            await asyncio.sleep(0)
+            seen = supergood_client._current_tags()
+            await asyncio.sleep(0)
+        return seen, supergood_client._current_tags()
+
+    async def run():
+        return await asyncio.gather(tagged("a"), tagged("b"))
+
+    assert asyncio.run(run()) == [
+        ({"task": "a"}, None),
+        ({"task": "b"}, None),
+    ]
+
+
+def test_tags_follow_into_executors(httpserver, supergood_client):
+    async def run():
+        with supergood_client.tagging({"customer": "kazooie"}):
+            # what asyncio.to_thread does, which 3.8 lacks
+            context = contextvars.copy_context()
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                context.run,
+                supergood_client._cache_request,
+                "tagged",
+                httpserver.url_for("/200"),
+                "GET",
+                b"",
+                {},
+            )
+
+    asyncio.run(run())
+    supergood_client.flush_cache(force=True)
+    args = Api.post_events.call_args[0][0]
+    assert args[0]["metadata"]["tags"] == {"customer": "kazooie"}
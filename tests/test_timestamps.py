@@ -0,0 +1,44 @@
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+from supergood.api import Api
+from supergood.helpers import elapsed_ms
+
+
+def test_elapsed_ms():
+    assert elapsed_ms(1_000_000, 3_500_000) == 2.5
+
+
+def test_formats_timestamps_on_flush(httpserver, supergood_client):
+    httpserver.expect_request("/200").respond_with_data("ok")
+    before = datetime.utcnow()
+    requests.get(httpserver.url_for("/200"))
+    cached = list(supergood_client._response_cache.values())[0]
+    # nothing is formatted on the request thread
+    assert isinstance(cached["request"]["requestedAt"], int)
+    assert isinstance(cached["response"]["respondedAt"], int)
+    supergood_client.flush_cache()
+    args = Api.post_events.call_args[0][0]
+    requested_at = datetime.strptime(
+        args[0]["request"]["requestedAt"], supergood_client.time_format
+    )
+    responded_at = datetime.strptime(
+        args[0]["response"]["respondedAt"], supergood_client.time_format
+    )
+    # wall clock and perf counter may be a tick apart
+    assert before - timedelta(milliseconds=1) <= requested_at <= responded_at
+    response = args[0]["response"]
+    assert response["duration"] >= response["timeToFirstByte"] >= 0
+
+
+def test_format_timestamp(supergood_client):
+    now = time.perf_counter_ns()
+    formatted = supergood_client._format_timestamp(now)
+    parsed = datetime.strptime(formatted, supergood_client.time_format)
+    assert abs(parsed - datetime.utcnow()) < timedelta(seconds=1)
+    later = supergood_client._format_timestamp(now + 1_500_000)
+    assert datetime.strptime(later, supergood_client.time_format) - parsed == (
+        timedelta(microseconds=1500)
+    )
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+from pytest_httpserver import HTTPServer
+
+from supergood.api import Api
+from supergood.vendors.aiohttp import patch
+
+BODY = b'{"streamed": "in", "many": "chunks"}'
+
+
+class UnfinishedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # promises more than it sends, then waits for the client to go away
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY) * 10))
+        self.end_headers()
+        self.wfile.write(BODY)
+        self.wfile.flush()
+        self.rfile.read()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def unfinished_server():
+    server = ThreadingHTTPServer(("localhost", 0), UnfinishedHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def flushed_events(supergood_client):
+    supergood_client.flush_cache()
+    return Api.post_events.call_args[0][0]
+
+
+class TestAiohttp:
+    def test_read(self, httpserver: HTTPServer, supergood_client):
+        httpserver.expect_request("/read").respond_with_data(BODY)
+
+        async def request():
+            async with aiohttp.ClientSession() as session:
+                async with session.post(
+                    httpserver.url_for("/read"), json={"sent": "body"}
+                ) as response:
+                    return await response.read()
+
+        assert run(request()) == BODY
+        events = flushed_events(supergood_client)
+        assert len(events) == 1
+        assert events[0]["request"]["method"] == "POST"
+        assert events[0]["request"]["body"] == {"sent": "body"}
+        assert events[0]["response"]["body"] == {"streamed": "in", "many": "chunks"}
+        assert events[0]["metadata"]["connectionReused"] is False
+
+    def test_streamed_reads(self, httpserver: HTTPServer, supergood_client):
+        httpserver.expect_request("/stream").respond_with_data(BODY)
+
+        async def request():
+            chunks = []
+            async with aiohttp.ClientSession() as session:
+                async with session.get(httpserver.url_for("/stream")) as response:
+                    async for chunk in response.content.iter_chunked(4):
+                        chunks.append(chunk)
+                async with session.get(httpserver.url_for("/stream")) as response:
+                    line = await response.content.readline()
+            return b"".join(chunks), line
+
+        assert run(request()) == (BODY, BODY)
+        events = flushed_events(supergood_client)
+        assert len(events) == 2
+        assert events[0]["response"]["body"]["many"] == "chunks"
+        assert events[1]["response"]["body"]["many"] == "chunks"
+        # the test server closes connections, so none are reused
+        assert events[1]["metadata"]["connectionReused"] is False
+
+    def test_released_before_eof(self, httpserver: HTTPServer, supergood_client):
+        httpserver.expect_request("/unread").respond_with_data(BODY)
+
+        async def request():
+            async with aiohttp.ClientSession() as session:
+                async with session.get(httpserver.url_for("/unread")) as response:
+                    return response.status
+
+        assert run(request()) == 200
+        events = flushed_events(supergood_client)
+        assert len(events) == 1
+        assert len(supergood_client._request_cache) == 0
+
+    def test_patching_again_replaces_the_wrapper(
+        self, httpserver: HTTPServer, supergood_client
+    ):
+        # e.g. a second Client.initialize
+        patch(supergood_client._cache_request, supergood_client._cache_response)
+        httpserver.expect_request("/read").respond_with_data(BODY)
+
+        async def request():
+            async with aiohttp.ClientSession() as session:
+                async with session.get(httpserver.url_for("/read")) as response:
+                    return await response.read()
+
+        assert run(request()) == BODY
+        assert len(flushed_events(supergood_client)) == 1
+
+    def test_closed_before_eof(self, unfinished_server, supergood_client):
+        host, port = unfinished_server.server_address
+        url = f"http://{host}:{port}/unfinished"
+
+        async def request():
+            session = aiohttp.ClientSession()
+            for _ in range(5):
+                response = await session.get(url)
+                assert await response.content.read(4) == BODY[:4]
+            await session.close()
+
+        run(request())
+        events = flushed_events(supergood_client)
+        assert len(events) == 5
+        assert len(supergood_client._request_cache) == 0
@@ -0,0 +1,118 @@
+import http.client
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from pytest_httpserver import HTTPServer as PytestHTTPServer
+
+from supergood.api import Api
+from supergood.vendors.http import patch
+
+BODY = b'{"chunked": "reads", "are": "captured whole"}'
+
+
+class ChunkedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i in range(0, len(BODY), 4):
+            chunk = BODY[i : i + 4]
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def chunked_server():
+    # a connection left open (e.g. by a failing test) must not block shutdown
+    server = ThreadingHTTPServer(("localhost", 0), ChunkedHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_response(httpserver, path):
+    connection = http.client.HTTPConnection(httpserver.host, httpserver.port)
+    connection.request("GET", path)
+    return connection.getresponse()
+
+
+def flushed_body(supergood_client):
+    supergood_client.flush_cache()
+    args = Api.post_events.call_args[0][0]
+    assert len(args) == 1
+    return args[0]["response"]["body"]
+
+
+class TestHttpClient:
+    def test_partial_reads(self, httpserver: PytestHTTPServer, supergood_client):
+        httpserver.expect_request("/partial").respond_with_data(BODY)
+        response = get_response(httpserver, "/partial")
+        parts = []
+        while part := response.read(5):
+            parts.append(part)
+        assert b"".join(parts) == BODY
+        assert flushed_body(supergood_client) == {
+            "chunked": "reads",
+            "are": "captured whole",
+        }
+
+    def test_readinto_and_read1(self, httpserver: PytestHTTPServer, supergood_client):
+        httpserver.expect_request("/readinto").respond_with_data(BODY)
+        response = get_response(httpserver, "/readinto")
+        buffer = bytearray(8)
+        n = response.readinto(buffer)
+        rest = response.read1(-1) + response.read()
+        assert bytes(buffer[:n]) + rest == BODY
+        assert flushed_body(supergood_client)["chunked"] == "reads"
+
+    def test_chunked_transfer(self, chunked_server, supergood_client):
+        connection = http.client.HTTPConnection(*chunked_server.server_address)
+        try:
+            connection.request("GET", "/chunked")
+            response = connection.getresponse()
+            assert response.chunked
+            lines = []
+            while line := response.readline():
+                lines.append(line)
+        finally:
+            connection.close()
+        assert b"".join(lines) == BODY
+        assert flushed_body(supergood_client)["are"] == "captured whole"
+
+    def test_close_before_eof(self, httpserver: PytestHTTPServer, supergood_client):
+        httpserver.expect_request("/closed").respond_with_data(BODY)
+        response = get_response(httpserver, "/closed")
+        assert response.read(10) == BODY[:10]
+        response.close()
+        assert flushed_body(supergood_client) == BODY[:10].decode("utf-8")
+        # nothing more is captured after close
+        response.read()
+        Api.post_events.reset_mock()
+        supergood_client.flush_cache()
+        Api.post_events.assert_not_called()
+
+    def test_patching_again_replaces_the_wrapper(
+        self, httpserver: PytestHTTPServer, supergood_client
+    ):
+        # e.g. a second Client.initialize
+        patch(
+            supergood_client._cache_request,
+            supergood_client._cache_response,
+            stream_limit=supergood_client.base_config["responseBodyByteLimit"],
+        )
+        httpserver.expect_request("/again").respond_with_data(BODY)
+        response = get_response(httpserver, "/again")
+        assert response.read(5) + response.read() == BODY
+        assert flushed_body(supergood_client)["chunked"] == "reads"
+        # a stacked wrapper would have cached the request twice
+        assert len(supergood_client._request_cache) == 0
@@ -1,7 +1,10 @@
+import asyncio
+
 import httpx
 from pytest_httpserver import HTTPServer
 
 from supergood.api import Api
+from supergood.vendors.httpx import patch
 
 
 class TestHttpx:
@@ -22,3 +25,117 @@ class TestHttpx:
         # verifies valid JSON is indexible
         assert args[0]["response"]["body"][0]["data"][0]["valid"] == "json"
         supergood_client.kill()
+
+    def test_httpx_streamed_upload_is_teed(
+        self, httpserver: HTTPServer, supergood_client
+    ):
+        httpserver.expect_request("/upload").respond_with_data("ok")
+        chunks = [b'{"name": ', b'"banjo"}']
+
+        def upload():
+            yield from chunks
+
+        response = httpx.post(
+            httpserver.url_for("/upload"),
+            content=upload(),
+            headers={"content-type": "application/json"},
+        )
+        assert response.status_code == 200
+        # the server got the whole body, the capture didn't drain the generator
+        assert httpserver.log[0][0].get_data() == b"".join(chunks)
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert args[0]["request"]["body"] == {"name": "banjo"}
+        assert "truncated" not in args[0]["metadata"]
+        supergood_client.kill()
+
+    def test_httpx_streamed_upload_is_truncated(
+        self, httpserver: HTTPServer, supergood_client
+    ):
+        httpserver.expect_request("/upload").respond_with_data("ok")
+        supergood_client.base_config["requestBodyByteLimit"] = 10
+        body = b"x" * 25
+
+        def upload():
+            for i in range(0, len(body), 5):
+                yield body[i : i + 5]
+
+        try:
+            httpx.post(
+                httpserver.url_for("/upload"),
+                content=upload(),
+                headers={"content-type": "text/plain"},
+            )
+        finally:
+            supergood_client.base_config["requestBodyByteLimit"] = 500000
+        assert httpserver.log[0][0].get_data() == body
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert args[0]["metadata"]["truncated"]["requestBody"]["size"] == 25
+        supergood_client.kill()
+
+    def test_httpx_binary_upload_is_skipped(
+        self, httpserver: HTTPServer, supergood_client
+    ):
+        httpserver.expect_request("/upload").respond_with_data("ok")
+        httpx.post(
+            httpserver.url_for("/upload"),
+            content=b"\x00\x01\x02",
+            headers={"content-type": "application/octet-stream"},
+        )
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert args[0]["request"]["body"] == ""
+        supergood_client.kill()
+
+    def test_httpx_async_streamed_upload_is_teed(
+        self, httpserver: HTTPServer, supergood_client
+    ):
+        httpserver.expect_request("/upload").respond_with_data("ok")
+
+        async def upload():
+            yield b"hello "
+            yield b"world"
+
+        async def send():
+            async with httpx.AsyncClient() as client:
+                return await client.post(
+                    httpserver.url_for("/upload"),
+                    content=upload(),
+                    headers={"content-type": "text/plain"},
+                )
+
+        response = asyncio.run(send())
+        assert response.status_code == 200
+        assert httpserver.log[0][0].get_data() == b"hello world"
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert args[0]["request"]["body"] == "hello world"
+        supergood_client.kill()
+
+    def test_patching_again_replaces_the_wrapper(
+        self, httpserver: HTTPServer, supergood_client
+    ):
+        raw_response = 'data: {"valid": "json"}\n\ndata: [DONE]\n\n'
+        httpserver.expect_request("/stream").respond_with_data(
+            response_data=raw_response
+        )
+        # e.g. a second Client.initialize, the first one's limit no longer applies
+        patch(supergood_client._cache_request, supergood_client._cache_response, 10)
+        patch(
+            supergood_client._cache_request,
+            supergood_client._cache_response,
+            stream_limit=supergood_client.base_config["responseBodyByteLimit"],
+            request_limit=supergood_client.base_config["requestBodyByteLimit"],
+        )
+        with httpx.stream("GET", httpserver.url_for("/stream")) as s:
+            for _ in s.iter_bytes(chunk_size=1):
+                pass
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 1
+        assert len(args[0]["response"]["body"]) == 2
+        assert "truncated" not in args[0]["metadata"]
+        # a stacked wrapper would have cached the request twice
+        assert len(supergood_client._request_cache) == 0
+        supergood_client.kill()
@@ -0,0 +1,54 @@
+import os
+from uuid import UUID
+
+import pytest
+import requests
+
+from supergood.api import Api
+from supergood.vendors import helpers
+from supergood.vendors.helpers import format_request_id, new_request_id
+
+
+def test_request_ids_are_unique():
+    ids = [new_request_id() for _ in range(1000)]
+    assert len(set(ids)) == 1000
+    # same process, same prefix
+    assert len(set(id >> 64 for id in ids)) == 1
+
+
+def test_format_request_id():
+    request_id = new_request_id()
+    assert UUID(format_request_id(request_id)).int == request_id
+    assert format_request_id("already-a-string") == "already-a-string"
+
+
+def test_reset_changes_prefix():
+    before = new_request_id()
+    helpers._reset_request_ids()
+    after = new_request_id()
+    assert before >> 64 != after >> 64
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_forked_child_gets_new_prefix():
+    parent = new_request_id()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write_fd, str(new_request_id()).encode())
+        os._exit(0)
+    os.close(write_fd)
+    child = int(os.read(read_fd, 64).decode())
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    assert parent >> 64 != child >> 64
+
+
+def test_ids_rendered_on_flush(httpserver, supergood_client):
+    httpserver.expect_request("/200").respond_with_data("ok")
+    requests.get(httpserver.url_for("/200"))
+    (cached_id,) = supergood_client._response_cache.keys()
+    assert isinstance(cached_id, int)
+    supergood_client.flush_cache()
+    args = Api.post_events.call_args[0][0]
+    assert args[0]["request"]["id"] == str(UUID(int=cached_id))
@@ -0,0 +1,58 @@
+import gzip
+import json
+
+import requests
+from pytest_httpserver import HTTPServer
+
+from supergood.api import Api
+from supergood.constants import REQUEST_ID_KEY, RESPONSE_CAPTURE_KEY
+from supergood.vendors.requests import patch
+
+
+class TestRequests:
+    def test_captured_once_at_adapter(self, httpserver: HTTPServer, supergood_client):
+        httpserver.expect_request("/200").respond_with_json({"adapter": True})
+        response = requests.get(httpserver.url_for("/200"))
+        # the lower layers saw the call, but left it alone
+        original_response = response.raw._original_response
+        assert getattr(original_response, REQUEST_ID_KEY, None) is None
+        assert getattr(original_response, RESPONSE_CAPTURE_KEY) is None
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 1
+        assert args[0]["response"]["body"] == {"adapter": True}
+        assert args[0]["response"]["timeToFirstByte"] >= 0
+
+    def test_decoded_body(self, httpserver: HTTPServer, supergood_client):
+        httpserver.expect_request("/gzip").respond_with_data(
+            gzip.compress(json.dumps({"compressed": True}).encode("utf-8")),
+            headers={"Content-Encoding": "gzip"},
+            content_type="application/json",
+        )
+        requests.post(httpserver.url_for("/gzip"), json={"sent": True})
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert args[0]["request"]["body"] == {"sent": True}
+        assert args[0]["response"]["body"] == {"compressed": True}
+
+    def test_streamed_captured_below(self, httpserver: HTTPServer, supergood_client):
+        httpserver.expect_request("/stream").respond_with_data("streamed body")
+        with requests.get(httpserver.url_for("/stream"), stream=True) as response:
+            original_response = response.raw._original_response
+            assert getattr(original_response, REQUEST_ID_KEY) is not None
+            assert b"".join(response.iter_content(3)) == b"streamed body"
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 1
+        assert args[0]["response"]["body"] == "streamed body"
+
+    def test_patching_again_replaces_the_wrapper(
+        self, httpserver: HTTPServer, supergood_client
+    ):
+        # e.g. a second Client.initialize
+        patch(supergood_client._cache_request, supergood_client._cache_response)
+        httpserver.expect_request("/200").respond_with_json({"once": True})
+        requests.get(httpserver.url_for("/200"))
+        supergood_client.flush_cache()
+        args = Api.post_events.call_args[0][0]
+        assert len(args) == 1
@@ -0,0 +1,90 @@
+import json
+
+from supergood.vendors.helpers import StreamAccumulator, is_text_content
+
+SSE_STREAM = (
+    b'data: {"valid": "json"}\r\n\r\n'
+    b"event: update\ndata: partial\nid: 7\n\n"
+    b": keepalive\n\n"
+    b"data: [DONE]\r\r"
+)
+
+
+def parse(accumulator):
+    return json.loads(accumulator.finish())
+
+
+def test_raw_chunks_are_joined():
+    accumulator = StreamAccumulator()
+    for chunk in (b"abc", "def", b"ghi"):
+        accumulator.feed(chunk)
+    assert accumulator.finish() == b"abcdefghi"
+    assert accumulator.truncation is None
+
+
+def test_raw_limit_keeps_what_fits():
+    accumulator = StreamAccumulator(limit=5)
+    accumulator.feed(b"abc")
+    accumulator.feed(b"defg")
+    accumulator.feed(b"hij")
+    assert accumulator.finish() == b"abcde"
+    assert accumulator.truncation == {"size": 10, "retained": 5}
+
+
+def test_sse_events_parsed_incrementally():
+    whole = StreamAccumulator(sse=True)
+    whole.feed(SSE_STREAM)
+    # dispatching blank lines split across chunks, in every line ending style
+    bytewise = StreamAccumulator(sse=True)
+    for i in range(len(SSE_STREAM)):
+        bytewise.feed(SSE_STREAM[i : i + 1])
+    events = parse(whole)
+    assert parse(bytewise) == events
+    assert len(events) == 3
+    assert events[0]["data"] == [{"valid": "json"}]
+    assert events[1] == {
+        "event": "update",
+        "data": ["partial"],
+        "id": "7",
+        "retry": None,
+    }
+    assert events[2]["data"] == ["[DONE]"]
+
+
+def test_sse_leftover_kept_as_string():
+    accumulator = StreamAccumulator(sse=True)
+    accumulator.feed(b"data: done\n\nnot an event")
+    events = parse(accumulator)
+    assert events[1] == "not an event"
+
+
+def test_sse_limit_drops_later_events():
+    accumulator = StreamAccumulator(limit=100, sse=True)
+    for _ in range(10):
+        accumulator.feed(b"data: " + b"x" * 20 + b"\n\n")
+    events = parse(accumulator)
+    assert len(events) == 1
+    assert accumulator.truncation["size"] == 280
+    assert accumulator.truncation["retained"] < 100
+
+
+def test_sse_pending_event_capped_at_limit():
+    accumulator = StreamAccumulator(limit=1000, sse=True)
+    accumulator.feed(b"data: kept\n\n")
+    # no event boundary anywhere, e.g. a large non-SSE download
+    for _ in range(100):
+        accumulator.feed(b"x" * 100000)
+        assert len(accumulator._pending) <= 1000
+    assert parse(accumulator)[0]["data"] == ["kept"]
+    assert accumulator.truncation["size"] == 10000012
+
+
+def test_is_text_content():
+    assert is_text_content(None)
+    assert is_text_content("application/json; charset=utf-8")
+    assert is_text_content("application/vnd.api+json")
+    assert is_text_content("text/csv")
+    assert is_text_content("application/x-www-form-urlencoded")
+    assert not is_text_content("application/octet-stream")
+    assert not is_text_content("multipart/form-data; boundary=xyz")
+    assert not is_text_content("image/png")